@@ -3,6 +3,22 @@
 # Copyright (C) 2016, AdaCore
 #
 # Python script to generate MMU tables.
+#
+# By default, one set of tables is generated, for the architecture and
+# mode given on the command line. With --sets, all the table sets
+# described in memmap.xml are generated from the same list of regions:
+#
+#  <memmap arch="aarch64">
+#    <tableset name="el2" mode="el2"/>
+#    <tableset name="s2" mode="stage2" cpus="0-3"/>
+#    <region ... tables="s2" cpus="1"/>
+#  </memmap>
+#
+# A tableset with a cpus attribute is generated once per CPU (the symbols
+# of CPU N are prefixed by __mmu_<name>_cpuN, __mmu_<name> otherwise).
+# Regions are in all the sets, unless restricted by the 'tables'
+# attribute (list of set names) or the 'cpus' attribute (list of CPUs, for
+# the per-CPU sets). Identical tables are only emitted once.
 
 import getopt
 import sys
@@ -15,6 +31,34 @@ class ConfigException(Exception):
     pass
 
 
+class TablePool(object):
+    """The tables emitted so far, by content. When several table sets are
+    generated, a table identical to one already emitted (same entries,
+    including the subtables they point to) is not emitted again: its
+    symbol is defined as an alias of the first one."""
+    def __init__(self):
+        self.tables = {}
+        self.emitted = 0
+        self.shared = 0
+
+    def emit(self, sym, align, entries, comment):
+        """Emit the table SYM, and return the symbol to use to refer to it.
+        The comments of the entries are not significant."""
+        key = (align,
+               tuple(e.split(comment)[0].rstrip() for e in entries))
+        if key in self.tables:
+            self.shared += 1
+            print("{} = {}".format(sym, self.tables[key]))
+            return self.tables[key]
+        self.tables[key] = sym
+        self.emitted += 1
+        print("\t.p2align %d" % align)
+        print(sym + ":")
+        for e in entries:
+            print(e)
+        return sym
+
+
 class Arch(object):
     """Describe the architecture to build the MMU tables"""
     def pageshift(self):
@@ -23,7 +67,7 @@ class Arch(object):
     def insert(self, name, virt, phys, size, cache, access):
         pass
 
-    def generate(self, prefix):
+    def generate(self, prefix, pool=None):
         pass
 
 
@@ -72,7 +116,7 @@ class arm_mmu(Arch):
         # Fill tt
         p = phys
         for v in range(virt, virt + size, self.pagesize):
-            vn = v / self.pagesize
+            vn = v // self.pagesize
             if self.tt[vn]:
                 print("overlap at %s in region %s" % (hex(v), name))
                 exit(1)
@@ -86,10 +130,11 @@ class arm_mmu(Arch):
                            'val': val}
             p += self.pagesize
 
-    def generate(self, prefix):
+    def generate(self, prefix, pool=None):
+        if pool is None:
+            pool = TablePool()
         addr = 0
-        print("\t.p2align 14")
-        print("{}_l0:".format(prefix))
+        entries = []
         for e in self.tt:
             if e:
                 v = e['val']
@@ -98,8 +143,9 @@ class arm_mmu(Arch):
                 v = 0
                 n = "*none*"
 
-            print("\t.long 0x%08x  @ for 0x%08x, %s" % (v, addr, n))
+            entries.append("\t.long 0x%08x  @ for 0x%08x, %s" % (v, addr, n))
             addr += self.pagesize
+        return pool.emit("{}_l0".format(prefix), 14, entries, '@')
 
 
 class aarch64_mmu(Arch):
@@ -120,12 +166,12 @@ class aarch64_mmu(Arch):
                 bt = 0x1
             self.val = upper + (pa & 0x0000fffffffff000) + lower + bt
 
-        def generate_table(self, prefix, level):
+        def generate_table(self, prefix, level, pool):
             pass
 
         def generate_entry(self, prefix, level):
-            print("\t.dword 0x%016x  // for 0x%08x, %s" %
-                  (self.val, self.va, self.name))
+            return ("\t.dword 0x%016x  // for 0x%08x, %s" %
+                    (self.val, self.va, self.name))
 
     class aarch64_pgd(object):
         def __init__(self, mmu, va, va_shift):
@@ -133,6 +179,8 @@ class aarch64_mmu(Arch):
             self.tt = [None for x in range(1 << self.mmu.log2_entries)]
             self.va = va
             self.va_shift = va_shift
+            # Symbol of the table, once emitted
+            self.sym = None
 
         def generate_entry(self, prefix, level):
             # NSTable: 0
@@ -140,25 +188,25 @@ class aarch64_mmu(Arch):
             # XNTable: 0
             # PXNTable: 0
             v = 0x3
-            print("\t.dword {}_l{}_{:09x} + 0x{:x}".format(
-                prefix, level, self.va >> self.mmu.pageshift, v))
+            return "\t.dword {} + 0x{:x}".format(self.sym, v)
 
-        def generate_table(self, prefix, level):
+        def generate_table(self, prefix, level, pool):
             # First the next level
             for t1 in self.tt:
                 if t1:
-                    t1.generate_table(prefix, level + 1)
+                    t1.generate_table(prefix, level + 1, pool)
             # then the pgd
-            print("\t.p2align %d" % self.mmu.pageshift)
-            sym = "{}_l{}_{:09x}".format(
-                prefix, level, self.va >> self.mmu.pageshift)
-            print(sym + ":")
+            entries = []
             for t1 in self.tt:
                 if t1:
-                    t1.generate_entry(prefix, level + 1)
+                    entries.append(t1.generate_entry(prefix, level + 1))
                 else:
-                    print("\t.dword 0")
-            return sym
+                    entries.append("\t.dword 0")
+            self.sym = pool.emit(
+                "{}_l{}_{:09x}".format(
+                    prefix, level, self.va >> self.mmu.pageshift),
+                self.mmu.pageshift, entries, '//')
+            return self.sym
 
     def __init__(self, mode, root):
         # Pagesize
@@ -304,7 +352,9 @@ class aarch64_mmu(Arch):
                 sl0 = 3 - level
             self.tcr |= (sl0 << 6)
 
-    def generate(self, prefix):
+    def generate(self, prefix, pool=None):
+        if pool is None:
+            pool = TablePool()
         #  First level
         level = {12: 0, 14: 0, 16: 1}[self.log2_granule]
         va_max = 48
@@ -330,7 +380,7 @@ class aarch64_mmu(Arch):
             level, sz, va_max))
         self.set_tcr(level, va_max)
         t.tt = t.tt[0:sz]
-        res = t.generate_table(prefix, level)
+        res = t.generate_table(prefix, level, pool)
         print("{}_tcr = 0x{:08x}".format(prefix, self.tcr))
         return res
 
@@ -350,22 +400,59 @@ def parse_addr(str):
         return int(ustr)
 
 
+def parse_cpus(str):
+    """Helper to translate a list of CPUs ("0,2" or "0-3") to a list"""
+    res = []
+    for item in str.split(','):
+        if '-' in item:
+            first, last = item.split('-')
+            res += range(int(first), int(last) + 1)
+        else:
+            res.append(int(item))
+    return res
+
+
 class mmu_region(object):
-    def __init__(self, name, virt, phys, size, cache, access):
+    def __init__(self, name, virt, phys, size, cache, access,
+                 tables=None, cpus=None):
         self.name = name
         self.virt = virt
         self.phys = phys
         self.size = size
         self.cache = cache
         self.access = access
+        # Table sets and CPUs of the region, None for all
+        self.tables = tables
+        self.cpus = cpus
 
+    def in_set(self, tableset):
+        if self.tables is not None and tableset.name not in self.tables:
+            return False
+        if self.cpus is not None and tableset.cpu is not None and \
+                tableset.cpu not in self.cpus:
+            return False
+        return True
 
-def parse_memmap(mmu, root):
+
+class mmu_tableset(object):
+    def __init__(self, name, arch, mode, cpu):
+        self.name = name
+        self.arch = arch
+        self.mode = mode
+        self.cpu = cpu
+
+    @property
+    def prefix(self):
+        if self.cpu is None:
+            return "__mmu_%s" % self.name
+        return "__mmu_%s_cpu%d" % (self.name, self.cpu)
+
+
+def parse_regions(root):
     res = []
 
     # Create entries for each regions
-    pagesize = 1 << mmu.pageshift
-    for child in root:
+    for child in root.findall('region'):
         name = child.attrib['name']
         virt = parse_addr(child.attrib['virt'])
         if 'phys' in child.attrib:
@@ -373,21 +460,61 @@ def parse_memmap(mmu, root):
         else:
             phys = virt
         size = parse_addr(child.attrib['size'])
-        if (virt % pagesize) != 0:
-            sys.stderr.write("%s.virt is not aligned\n" % name)
+
+        cache = child.attrib['cache']
+        access = child.attrib['access']
+
+        tables = None
+        if 'tables' in child.attrib:
+            tables = [t.strip() for t in child.attrib['tables'].split(',')]
+        cpus = None
+        if 'cpus' in child.attrib:
+            cpus = parse_cpus(child.attrib['cpus'])
+
+        res.append(mmu_region(name, virt, phys, size, cache, access,
+                              tables, cpus))
+
+    return res
+
+
+def check_regions(mmu, regions):
+    pagesize = 1 << mmu.pageshift
+    for r in regions:
+        if (r.virt % pagesize) != 0:
+            sys.stderr.write("%s.virt is not aligned\n" % r.name)
             exit(1)
-        if (phys % pagesize) != 0:
-            sys.stderr.write("%s.phys is not aligned\n" % name)
+        if (r.phys % pagesize) != 0:
+            sys.stderr.write("%s.phys is not aligned\n" % r.name)
             exit(1)
-        if (size % pagesize) != 0:
-            sys.stderr.write("size of %s is not aligned\n" % name)
+        if (r.size % pagesize) != 0:
+            sys.stderr.write("size of %s is not aligned\n" % r.name)
             exit(1)
 
-        cache = child.attrib['cache']
-        access = child.attrib['access']
 
-        res.append(mmu_region(name, virt, phys, size, cache, access))
+def parse_memmap(mmu, root):
+    res = parse_regions(root)
+    check_regions(mmu, res)
+    return res
+
 
+def parse_tablesets(root, arch=None):
+    """Return the list of table sets described in root, one per CPU for the
+    per-CPU sets"""
+    res = []
+    names = []
+    for child in root.findall('tableset'):
+        name = child.attrib['name']
+        if name in names:
+            sys.stderr.write("error: table set %s defined twice\n" % name)
+            sys.exit(1)
+        names.append(name)
+        set_arch = child.attrib.get('arch', arch or root.attrib.get('arch'))
+        mode = child.attrib.get('mode')
+        if 'cpus' in child.attrib:
+            for cpu in parse_cpus(child.attrib['cpus']):
+                res.append(mmu_tableset(name, set_arch, mode, cpu))
+        else:
+            res.append(mmu_tableset(name, set_arch, mode, None))
     return res
 
 
@@ -413,11 +540,47 @@ def create_mmu_from_xml(root, arch=None, mode=None):
     return mmu
 
 
+def generate_tablesets(root, arch=None):
+    """Generate all the table sets of root, from a single list of regions"""
+    tablesets = parse_tablesets(root, arch)
+    if len(tablesets) == 0:
+        sys.stderr.write("error: no tableset in %s\n" % filename)
+        sys.exit(1)
+    regions = parse_regions(root)
+    names = [ts.name for ts in tablesets]
+    for r in regions:
+        for name in r.tables or []:
+            if name not in names:
+                sys.stderr.write("error: unknown table set %s for region %s\n"
+                                 % (name, r.name))
+                sys.exit(1)
+
+    pool = TablePool()
+    for ts in tablesets:
+        desc = "// Table set {}".format(ts.name)
+        if ts.mode is not None:
+            desc += ", mode {}".format(ts.mode)
+        if ts.cpu is not None:
+            desc += ", cpu {}".format(ts.cpu)
+        print(desc)
+        mmu = create_mmu_from_xml(root, ts.arch, ts.mode)
+        set_regions = [r for r in regions if r.in_set(ts)]
+        check_regions(mmu, set_regions)
+        for r in set_regions:
+            mmu.insert(r.name, r.virt, r.phys, r.size, r.cache, r.access)
+        mmu.generate(ts.prefix, pool)
+        print("")
+    print("// {} tables, {} shared".format(
+        pool.emitted + pool.shared, pool.shared))
+
+
 def usage():
     print("usage: memmap.py OPTIONS [INPUT]")
     print("Options are:")
     print(" --arch=ARCH      set architecture")
     print("    architectures are: %s" % ", ".join(arches.keys()))
+    print(" --el1, --el2     set the exception level (aarch64)")
+    print(" --sets           generate all the table sets of INPUT")
 
 
 def main():
@@ -426,10 +589,11 @@ def main():
 
     arch = None
     mode = None
+    sets = False
 
     try:
         opts, args = getopt.getopt(
-            sys.argv[1:], "h", ["help", "arch=", "el1", "el2"])
+            sys.argv[1:], "h", ["help", "arch=", "el1", "el2", "sets"])
     except getopt.GetoptError as e:
         sys.stderr.write("error: " + str(e) + '\n')
         sys.stderr.write("Try --help\n")
@@ -443,6 +607,8 @@ def main():
         elif opt == "--el2":
             assert mode is None
             mode = "el2"
+        elif opt == "--sets":
+            sets = True
         elif opt in ("-h", "--help"):
             usage()
             sys.exit()
@@ -465,6 +631,10 @@ def main():
     tree = ET.parse(filename)
     root = tree.getroot()
 
+    if sets:
+        generate_tablesets(root, arch)
+        return
+
     mmu = create_mmu_from_xml(root, arch, mode)
 
     regions = parse_memmap(mmu, root)
@@ -0,0 +1,297 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020, AdaCore
+#
+# Benchmark of the runtime generation pipeline (gen_rts_sources.py and
+# build_rts.py). This does not need any cross compiler nor the actual gnat
+# and gcc sources: a synthetic source tree is generated from the list of
+# files referenced by the runtime sources and the targets.
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from support import fullpath
+from support.files_holder import FilesHolder, InstallManifest
+from support.bsp_sources.installer import Installer, InstallPlan
+from support.rts_sources import SourceTree
+from support.rts_sources.sources import all_scenarios, sources
+
+import build_rts
+
+# Version of the results format
+FORMAT_VERSION = 1
+
+# Size range of the synthetic source files, roughly that of the actual gnat
+# runtime sources
+MIN_FILE_SIZE = 1024
+MAX_FILE_SIZE = 48 * 1024
+
+
+def _synthetic_size(name):
+    "Deterministic pseudo-random size for the file name"
+    h = int(hashlib.sha1(name.encode()).hexdigest()[:8], 16)
+    return MIN_FILE_SIZE + h % (MAX_FILE_SIZE - MIN_FILE_SIZE)
+
+
+def _write_synthetic(path, name):
+    if os.path.exists(path):
+        return
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    line = '--  synthetic content for %s\n' % name
+    size = _synthetic_size(name)
+    with open(path, 'w') as fp:
+        fp.write(line * (size // len(line) + 1))
+
+
+def create_synthetic_tree(root):
+    """Creates fake gnat and gcc source trees in root.
+
+    Returns the (gnatdir, gccdir) tuple."""
+    gnatdir = os.path.join(root, 'gnat')
+    gccdir = os.path.join(root, 'gcc')
+    manifest = []
+
+    files = set()
+    for values in sources.values():
+        for key in ('srcs', 'bb_srcs', 'pikeos_srcs'):
+            if key in values:
+                files.update(values[key])
+
+    for src in sorted(files):
+        if '/' not in src:
+            # MANIFEST.GNAT files
+            manifest.append(src)
+            dst = os.path.join(gnatdir, src)
+        elif src.split('/')[0] in ('hie', 'libgnarl', 'libgnat'):
+            dst = os.path.join(gnatdir, src)
+        elif os.path.exists(fullpath(src)):
+            # part of this repository
+            continue
+        else:
+            dst = os.path.join(gccdir, src)
+        _write_synthetic(dst, src)
+
+    with open(os.path.join(gnatdir, 'MANIFEST.GNAT'), 'w') as fp:
+        fp.write('--  synthetic manifest\n')
+        fp.write('\n'.join(manifest) + '\n')
+    os.makedirs(os.path.join(gccdir, 'gcc'))
+    with open(os.path.join(gccdir, 'gcc', 'BASE-VER'), 'w') as fp:
+        fp.write('10.0.0\n')
+
+    return gnatdir, gccdir
+
+
+class Timer(object):
+    """Runs a function several times and records the elapsed times"""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, name, fun, setup=None):
+        times = []
+        for _ in range(self.repeat):
+            arg = setup() if setup is not None else None
+            # Silence the pipeline's progress messages
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                fun(arg)
+                times.append(time.perf_counter() - start)
+        times.sort()
+        self.results[name] = {
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'max': times[-1],
+            'runs': len(times)}
+        print('%-24s min %8.2f ms  median %8.2f ms' % (
+            name, times[0] * 1000.0, times[len(times) // 2] * 1000.0))
+
+
+def _board_list():
+    """Returns the boards of build_configs that can be created with the
+    synthetic tree, and the list of the ones that cannot"""
+    ok = []
+    failed = []
+    for name in build_rts.ALL_BOARDS:
+        try:
+            build_rts.build_configs(name)
+            ok.append(name)
+        except (AssertionError, SystemExit):
+            failed.append(name)
+    return ok, failed
+
+
+def run_benchmarks(workdir, repeat):
+    gnatdir, gccdir = create_synthetic_tree(os.path.join(workdir, 'src'))
+    FilesHolder.gnatdir = gnatdir
+    FilesHolder.gccdir = gccdir
+    # The records of the installations are about the temporary trees
+    InstallManifest.state_dir = os.path.join(workdir, 'state', 'manifests')
+    InstallPlan.state_dir = os.path.join(workdir, 'state', 'plans')
+
+    timer = Timer(repeat)
+
+    def cold():
+        # Measure the cost seen by a new process
+        FilesHolder.resolved_sources.clear()
+
+    def new_tree(_=None):
+        return SourceTree(
+            is_bb=True, profile='ravenscar-full',
+            rts_sources=sources, rts_scenarios=all_scenarios)
+
+    timer.run('source_tree', new_tree, setup=cold)
+
+    dest = os.path.join(workdir, 'install')
+    dest_json = os.path.join(dest, 'lib', 'gnat', 'rts-sources.json')
+    dest_srcs = os.path.join(dest, 'include', 'rts-sources')
+
+    def dump_sources_json(tree):
+        for lib in ('gnat', 'gnarl'):
+            tree.dump_sources_json(
+                dest_srcs, os.path.dirname(dest_json), libname=lib,
+                scenarios=list(tree.lib_scenarios[lib]),
+                dirs=dict(tree.rules[lib]), env={})
+
+    timer.run('dump_sources_json', dump_sources_json, setup=new_tree)
+
+    # Generate the runtime sources used by the installer
+    os.makedirs(os.path.dirname(dest_json))
+    with contextlib.redirect_stdout(io.StringIO()):
+        new_tree().install_tree(dest_json=dest_json, dest_sources=dest_srcs)
+
+    boards, skipped = _board_list()
+    if len(skipped) > 0:
+        print('skipped boards: %s' % ', '.join(skipped))
+
+    def instantiate(_):
+        return [build_rts.build_configs(b) for b in boards]
+
+    timer.run('target_instantiation', instantiate, setup=cold)
+
+    # PikeOS targets need PikeOS sources, that we don't generate here, and
+    # some boards are aliases generating the same runtimes
+    install_boards = []
+    rts_dirs = set()
+    for name, t in zip(boards, instantiate(None)):
+        if t.is_pikeos:
+            continue
+        if t.is_native:
+            dirs = set('rts-%s' % rts for rts in t.runtimes)
+        else:
+            dirs = set('%s-%s' % (rts, t.name) for rts in t.runtimes)
+        if len(dirs & rts_dirs) == 0:
+            rts_dirs |= dirs
+            install_boards.append(name)
+    count = [0]
+
+    def setup_install():
+        count[0] += 1
+        rts_dest = os.path.join(workdir, 'rts-%d' % count[0])
+        return rts_dest, [build_rts.build_configs(b) for b in install_boards]
+
+    def install(arg):
+        rts_dest, targets = arg
+        for t in targets:
+            Installer(t).install(rts_dest, rts_descriptor=dest_json)
+
+    timer.run('installer_install', install, setup=setup_install)
+
+    def dump_runtime_xml(targets):
+        for t in targets:
+            for name, rts in t.runtimes.items():
+                t.dump_runtime_xml(name, rts)
+
+    timer.run('dump_runtime_xml', dump_runtime_xml,
+              setup=lambda: instantiate(None))
+
+    return {
+        'version': FORMAT_VERSION,
+        'python': platform.python_version(),
+        'repeat': repeat,
+        'boards': len(boards),
+        'install_boards': len(install_boards),
+        'skipped_boards': skipped,
+        'results': timer.results}
+
+
+def compare(results, baseline, threshold):
+    """Compares results against baseline.
+
+    Returns False if a benchmark is slower than the baseline by more than
+    threshold (a ratio)."""
+    assert baseline.get('version') == FORMAT_VERSION, \
+        "incompatible baseline format version %s" % baseline.get('version')
+    ok = True
+    print('')
+    print('%-24s %12s %12s %8s' % (
+        'benchmark', 'baseline', 'current', 'ratio'))
+    for name in sorted(results['results'].keys()):
+        cur = results['results'][name]['min']
+        if name not in baseline['results']:
+            print('%-24s %12s %10.2fms %8s' % (name, '-', cur * 1000.0, '-'))
+            continue
+        base = baseline['results'][name]['min']
+        ratio = cur / base if base > 0 else 1.0
+        status = ''
+        if ratio > 1.0 + threshold:
+            status = '  REGRESSION'
+            ok = False
+        print('%-24s %10.2fms %10.2fms %8.2f%s' % (
+            name, base * 1000.0, cur * 1000.0, ratio, status))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=5,
+        help='number of runs of each benchmark (the minimum is kept)')
+    parser.add_argument(
+        '-o', '--output',
+        help='write the results to this json file')
+    parser.add_argument(
+        '--compare',
+        help='compare the results with this baseline json file')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help=('relative slowdown reported as a regression when comparing '
+              '(default 0.1, i.e. 10%%)'))
+    parser.add_argument(
+        '--keep', action='store_true',
+        help='keep the temporary work directory')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-rts-')
+    try:
+        results = run_benchmarks(workdir, args.repeat)
+    finally:
+        if args.keep:
+            print('work directory kept in %s' % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            fp.write(json.dumps(results, indent=2, sort_keys=True))
+            fp.write('\n')
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as fp:
+            baseline = json.load(fp)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
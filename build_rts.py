@@ -7,9 +7,19 @@
 # Python version starting from 2.6 (yes, it's very old but that's the system
 # python on oldest host).
 
-from support.files_holder import FilesHolder
-from support.bsp_sources.installer import Installer
+from support.files_holder import FilesHolder, InstallManifest
+from support.bsp_sources.archive import RuntimeArchive
+from support.bsp_sources.installer import Installer, InstallPlan
+from support.bsp_sources.query import query
+from support.bsp_sources.reverse_index import ReverseIndex
 from support.docgen import docgen
+from support.objcache import get_compiler_id
+from support.server import BuildServer
+from support.compile_times import CompileTimes, read_log
+from support.footprint import footprint, \
+     write_report as write_footprint_report
+from support.stack_usage import analyze as analyze_stack_usage, \
+     write_report as write_stack_report
 
 # PikeOS
 from pikeos import ArmPikeOS, ArmPikeOS42, ArmPikeOS5
@@ -45,138 +55,298 @@ from visium import Visium
 from native import X86Native, X8664Native
 
 import argparse
+import hashlib
+from functools import partial
+import json
 import os
+import shutil
 import subprocess
 import sys
 
 
-def build_configs(target):
+# The boards supported by build_configs, with the constructor of their
+# target
+BOARDS = (
     # PikeOS
-    if target == 'arm-pikeos':
-        t = ArmPikeOS()
-    elif target == 'arm-pikeos4.2':
-        t = ArmPikeOS42()
-    elif target == 'arm-pikeos5':
-        t = ArmPikeOS5()
+    ('arm-pikeos', ArmPikeOS),
+    ('arm-pikeos4.2', ArmPikeOS42),
+    ('arm-pikeos5', ArmPikeOS5),
     # AArch64 elf
-    elif target == 'rpi3':
-        t = Rpi3()
-    elif target == 'rpi3mc':
-        t = Rpi3Mc()
-    elif target == 'zynqmp':
-        t = ZynqMP()
+    ('rpi3', Rpi3),
+    ('rpi3mc', Rpi3Mc),
+    ('zynqmp', ZynqMP),
     # ARM elf
-    elif target == 'zynq7000':
-        t = Zynq7000()
-    elif target == 'rpi2':
-        t = Rpi2()
-    elif target == 'rpi2mc':
-        t = Rpi2Mc()
-    elif target.startswith('sam'):
-        t = Sam(target)
-    elif target.startswith('smartfusion2'):
-        t = SmartFusion2()
-    elif target.startswith('stm32'):
-        t = Stm32(target)
-    elif target == 'feather_stm32f405':
-        t = Stm32(target)
-    elif target == 'openmv2':
-        t = Stm32(target)
-    elif target == 'tms570':
-        # by default, the TMS570LS3137 HDK board
-        t = TMS570('tms570ls31')
-    elif target == 'tms570_sci':
-        # by default, the TMS570LS3137 HDK board
-        t = TMS570('tms570ls31', uart_io=True)
-    elif target == 'tms570lc':
-        # alias for the TMS570LC43x HDK board
-        t = TMS570('tms570lc43', uart_io=True)
-    elif target == 'tms570lc_dcc':
-        t = TMS570('tms570lc43', uart_io=False)
-    elif target == 'lm3s':
-        t = LM3S()
-    elif target == 'microbit':
-        t = Microbit()
-    elif target == 'nrf52840':
-        t = NRF52840()
-    elif target == 'nrf52832':
-        t = NRF52832()
-    elif target == "microsemi-m1":
-        t = MicrosemiM1()
-    elif target == 'cortex-m0':
-        t = CortexM0()
-    elif target == 'cortex-m0p':
-        t = CortexM0P()
-    elif target == 'cortex-m1':
-        t = CortexM1()
-    elif target == 'cortex-m3':
-        t = CortexM3()
-    elif target == 'cortex-m4':
-        t = CortexM4()
-    elif target == 'cortex-m4f':
-        t = CortexM4F()
-    elif target == 'cortex-m7f':
-        t = CortexM7F()
-    elif target == 'cortex-m7df':
-        t = CortexM7DF()
+    ('zynq7000', Zynq7000),
+    ('rpi2', Rpi2),
+    ('rpi2mc', Rpi2Mc),
+    ('sam4s', partial(Sam, 'sam4s')),
+    ('samg55', partial(Sam, 'samg55')),
+    ('samv71', partial(Sam, 'samv71')),
+    ('smartfusion2', SmartFusion2),
+    ('stm32f4', partial(Stm32, 'stm32f4')),
+    ('stm32f429disco', partial(Stm32, 'stm32f429disco')),
+    ('stm32f469disco', partial(Stm32, 'stm32f469disco')),
+    ('stm32f746disco', partial(Stm32, 'stm32f746disco')),
+    ('stm32756geval', partial(Stm32, 'stm32756geval')),
+    ('stm32f769disco', partial(Stm32, 'stm32f769disco')),
+    ('feather_stm32f405', partial(Stm32, 'feather_stm32f405')),
+    ('openmv2', partial(Stm32, 'openmv2')),
+    # by default, the TMS570LS3137 HDK board
+    ('tms570', partial(TMS570, 'tms570ls31')),
+    ('tms570_sci', partial(TMS570, 'tms570ls31', uart_io=True)),
+    # alias for the TMS570LC43x HDK board
+    ('tms570lc', partial(TMS570, 'tms570lc43', uart_io=True)),
+    ('tms570lc_dcc', partial(TMS570, 'tms570lc43', uart_io=False)),
+    ('lm3s', LM3S),
+    ('microbit', Microbit),
+    ('nrf52840', NRF52840),
+    ('nrf52832', NRF52832),
+    ('microsemi-m1', MicrosemiM1),
+    ('cortex-m0', CortexM0),
+    ('cortex-m0p', CortexM0P),
+    ('cortex-m1', CortexM1),
+    ('cortex-m3', CortexM3),
+    ('cortex-m4', CortexM4),
+    ('cortex-m4f', CortexM4F),
+    ('cortex-m7f', CortexM7F),
+    ('cortex-m7df', CortexM7DF),
     # SPARC/Leon elf
-    elif target == 'leon2' or target == 'leon':
-        t = Leon2()
-    elif target == 'leon3':
-        t = Leon3(smp=False)
-    elif target == 'leon3-smp':
-        t = Leon3(smp=True)
-    elif target == 'leon4':
-        t = Leon4(smp=False)
-    elif target == 'leon4-smp':
-        t = Leon4(smp=True)
+    ('leon2', Leon2),
+    ('leon3', partial(Leon3, smp=False)),
+    ('leon3-smp', partial(Leon3, smp=True)),
+    ('leon4', partial(Leon4, smp=False)),
+    ('leon4-smp', partial(Leon4, smp=True)),
     # m68k elf
-    elif target == 'm68020':
-        t = M68020()
-    elif target == 'm68020-softfloat':
-        t = M68020_SoftFloat()
+    ('m68020', M68020),
+    ('m68020-softfloat', M68020_SoftFloat),
     # PPC elf
-    elif target == 'mpc8641':
-        t = MPC8641()
-    elif target == '8349e':
-        t = MPC8349e()
-    elif target == 'p2020':
-        t = P2020()
-    elif target == 'p5566':
-        t = P5566()
-    elif target == 'mpc5634':
-        t = P5634()
+    ('mpc8641', MPC8641),
+    ('8349e', MPC8349e),
+    ('p2020', P2020),
+    ('p5566', P5566),
+    ('mpc5634', P5634),
     # Visium elf
-    elif target == 'mcm':
-        t = Visium()
+    ('mcm', Visium),
     # Risc-V
-    elif target == 'spike':
-        t = Spike()
-    elif target == 'hifive1':
-        t = HiFive1()
-    elif target == 'unleashed':
-        t = Unleashed()
-    elif target == 'picorv32':
-        t = PicoRV32()
-    elif target == 'rv32imc':
-        t = RV32IMC()
+    ('spike', Spike),
+    ('hifive1', HiFive1),
+    ('unleashed', Unleashed),
+    ('picorv32', PicoRV32),
+    ('rv32imc', RV32IMC),
     # native platforms
-    elif target == 'x86-linux':
-        t = X86Native()
-    elif target == 'x86-windows':
-        t = X86Native()
-    elif target == 'x86_64-linux':
-        t = X8664Native()
-    elif target == 'x86_64-windows':
-        t = X8664Native()
-    else:
-        print('Error: undefined target %s' % target)
-        sys.exit(2)
+    ('x86-linux', X86Native),
+    ('x86-windows', X86Native),
+    ('x86_64-linux', X8664Native),
+    ('x86_64-windows', X8664Native))
+
+# All the boards supported by build_configs
+ALL_BOARDS = tuple(name for name, _ in BOARDS)
+
+# Other names of the boards
+BOARD_ALIASES = {'leon': 'leon2'}
+
+# Families of boards: the board names starting with the prefix are passed
+# to the constructor
+BOARD_FAMILIES = (('sam', Sam),
+                  ('smartfusion2', lambda name: SmartFusion2()),
+                  ('stm32', Stm32))
+
+
+# Build artifacts removed from the obj directory of the built runtimes
+OBJECTS_EXT = ('.o', '.ali', '.stdout', '.stderr', '.d', '.lexch')
+
+# Compiler wrapper using the object cache (--object-cache)
+RTS_CC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rts_cc.py')
+
+# Location of the runtime sources in the debug info of the libraries. It
+# does not depend on the runtime directory, so that identical runtimes
+# produce identical libraries (use "set substitute-path" in gdb to find the
+# sources of an installed runtime).
+DEBUG_PREFIX = '/rts'
+
+# Languages compiled through the compiler wrapper
+CACHED_LANGUAGES = ('ada', 'c', 'asm', 'asm2', 'asm_cpp')
+
+# Directory where the build artifacts are kept with --keep-objects, in a
+# subdirectory per runtime. It is next to the other records of the
+# installations, out of the installed tree.
+OBJECTS_CACHE = os.path.join(
+    os.path.dirname(InstallManifest.state_dir), 'objects')
+
+
+def remove_objects(obj_dir):
+    """Removes the build artifacts from obj_dir"""
+    if not os.path.isdir(obj_dir):
+        return
+    for fname in os.listdir(obj_dir):
+        _, ext = os.path.splitext(fname)
+        if ext in OBJECTS_EXT:
+            os.unlink(os.path.join(obj_dir, fname))
+
+
+def move_objects(src_dir, dst_dir):
+    """Moves the build artifacts from src_dir to dst_dir.
+
+    The files are renamed, so their timestamps are preserved and gprbuild
+    only recompiles the units whose sources changed."""
+    if not os.path.isdir(src_dir):
+        return
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    for fname in os.listdir(src_dir):
+        _, ext = os.path.splitext(fname)
+        if ext in OBJECTS_EXT:
+            os.rename(os.path.join(src_dir, fname),
+                      os.path.join(dst_dir, fname))
+
+
+# Values of the BUILD external variable (see target_options.gpr)
+BUILD_TYPES = ('Production', 'Debug', 'Assert', 'Gnatcov')
+
+# Files and directories produced by the build of a runtime
+BUILD_OUTPUTS = ('adalib', 'ada_target_properties')
+
 
-    return t
+def link_build_outputs(src_dir, dst_dir):
+    """Hard links (or copies) the build outputs of the runtime in src_dir
+    to the runtime in dst_dir, that have the same fingerprint"""
+    def link(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
 
+    for name in BUILD_OUTPUTS:
+        src = os.path.join(src_dir, name)
+        dst = os.path.join(dst_dir, name)
+        if os.path.isdir(src):
+            if not os.path.isdir(dst):
+                os.makedirs(dst)
+            for fname in os.listdir(src):
+                link(os.path.join(src, fname), os.path.join(dst, fname))
+        elif os.path.isfile(src):
+            link(src, dst)
 
-def main():
+
+def build_runtime(staging, rts_path, projects, args, compiler, cc_id=None,
+                  build_type=None, jobs=0, times_log=None):
+    """Builds the projects of the runtime installed in staging, that will
+    be moved to rts_path.
+
+    ARGS are the command line arguments, COMPILER the compiler driver and
+    CC_ID its identification for the object cache.
+    BUILD_TYPE, if set, is the value of the BUILD external variable, and
+    JOBS the number of jobs of gprbuild.
+    TIMES_LOG, if set, is the file where the compilation times are
+    logged."""
+    obj_dir = os.path.join(staging, 'obj')
+    saved = os.path.join(
+        args.objects_dir,
+        hashlib.sha1(os.path.abspath(rts_path).encode('utf-8')).hexdigest())
+    if args.keep_objects:
+        move_objects(saved, obj_dir)
+    try:
+        for prj in projects:
+            print("building project %s" % prj)
+            sys.stdout.flush()
+            cmd = ['gprbuild', '-j%d' % jobs, '-p', '-P', prj]
+            if build_type is not None:
+                cmd.append('-XBUILD=%s' % build_type)
+            env = None
+            if args.object_cache is not None or times_log is not None:
+                # Compile through the wrapper
+                cmd += ['--compiler-subst=%s,%s' % (lang, RTS_CC)
+                        for lang in CACHED_LANGUAGES]
+                env = dict(os.environ)
+                env.update({
+                    'RTS_CC_COMPILER': compiler,
+                    'RTS_CC_ROOT': staging,
+                    'RTS_CC_FINAL': DEBUG_PREFIX,
+                    'RTS_CC_NAME': os.path.basename(rts_path)})
+                if args.object_cache is not None:
+                    env.update({
+                        'RTS_CC_ID': cc_id,
+                        'RTS_CC_CACHE': os.path.abspath(args.object_cache)})
+                if times_log is not None:
+                    env['RTS_CC_TIMES'] = times_log
+            if args.build_flags is not None:
+                cmd += args.build_flags.split()
+            # The debug info should not depend on the location of the
+            # runtime
+            cmd += ['-cargs', '-fdebug-prefix-map=%s=%s' % (
+                staging, DEBUG_PREFIX)]
+            subprocess.check_call(cmd, env=env)
+        if args.stack_report is not None:
+            stack_report(obj_dir, rts_path, args.stack_report)
+    finally:
+        # Post-process: remove build artifacts from obj directory, or keep
+        # them aside for the next build
+        if args.keep_objects:
+            move_objects(obj_dir, saved)
+        else:
+            remove_objects(obj_dir)
+            if os.path.exists(saved):
+                shutil.rmtree(saved)
+
+
+def stack_report(obj_dir, rts_path, report_dir):
+    """Writes the worst-case stack usage report of the runtime built in
+    obj_dir to report_dir"""
+    report = analyze_stack_usage([obj_dir])
+    report['runtime'] = os.path.basename(rts_path)
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+    fname = os.path.join(report_dir, '%s-stack.json' % report['runtime'])
+    write_stack_report(report, fname)
+    unbounded = [e for e in report['entry_points'] if not e['bounded']]
+    print("stack usage of %s: %d entry points (%d without a safe bound) "
+          "in %s" % (report['runtime'], len(report['entry_points']),
+                     len(unbounded), fname))
+
+
+def compile_times_report(times_log, db_file):
+    """Merges the compilation times logged in times_log into the database
+    db_file, and prints the ranking of the units and runtimes"""
+    db = CompileTimes.load(db_file)
+    db.add_records(read_log(times_log))
+    db.save(db_file)
+    if os.path.exists(times_log):
+        os.unlink(times_log)
+    print("compilation times (%d runs, in %s):" % (db.runs, db_file))
+    for line in db.ranking(db.units):
+        print("  " + line)
+    print("")
+    for line in db.ranking(db.runtimes):
+        print("  " + line)
+
+
+def footprint_report(staging, plan, rts_sources, report_dir):
+    """Writes the footprint report of the runtime built in staging with
+    plan to report_dir"""
+    report = footprint(staging, plan, rts_sources)
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+    base = os.path.join(report_dir, '%s-footprint' % report['runtime'])
+    write_footprint_report(report, base + '.json', base + '.csv')
+    totals = report['totals']
+    print("footprint of %s: text %d, rodata %d, data %d, bss %d in %s.json"
+          % (report['runtime'], totals['text'], totals['rodata'],
+             totals['data'], totals['bss'], base))
+
+
+def build_configs(target):
+    target = BOARD_ALIASES.get(target, target)
+    constructors = dict(BOARDS)
+    if target in constructors:
+        return constructors[target]()
+    for prefix, constructor in BOARD_FAMILIES:
+        if target.startswith(prefix):
+            return constructor(target)
+    print('Error: undefined target %s' % target)
+    sys.exit(2)
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -204,9 +374,114 @@ def main():
     parser.add_argument(
         '--build-flags', help="Flags passed to gprbuild")
     parser.add_argument(
-        'target', nargs='+',
+        '-j', '--jobs', type=int, default=0,
+        help=("Number of gprbuild jobs (0 = one per CPU), shared by the "
+              "build variants"))
+    parser.add_argument(
+        '--build-variants',
+        help=("Comma-separated list of build types (%s) to build, or 'all'. "
+              "They are built concurrently: the first one in the runtime "
+              "directory, the other ones in copies of the runtime suffixed "
+              "by the build type" % ', '.join(BUILD_TYPES)))
+    parser.add_argument(
+        '--object-cache',
+        help=("Directory of a cache of compiled objects, shared between "
+              "the runtimes and between runs"))
+    parser.add_argument(
+        '--compile-times', metavar='FILE',
+        help=("Time the compilation of each unit, accumulate the times in "
+              "the json database FILE (merged across runs) and print the "
+              "most expensive units and runtimes"))
+    parser.add_argument(
+        '--keep-objects', action="store_true",
+        help=("Keep the build artifacts aside and reuse them to rebuild "
+              "only what changed next time"))
+    parser.add_argument(
+        '--objects-dir', default=OBJECTS_CACHE,
+        help=("Where the build artifacts are kept with --keep-objects "
+              "(default: %s)" % OBJECTS_CACHE))
+    parser.add_argument(
+        '--stack-report', metavar='DIR',
+        help=("Write the worst-case stack usage of the entry points of the "
+              "built runtimes (task bodies, interrupt handlers, functions "
+              "not called by the runtime) to DIR/<runtime>-stack.json"))
+    parser.add_argument(
+        '--footprint-report', metavar='DIR',
+        help=("Write the code and data size of the built runtimes, per "
+              "runtime sources directory and scenario variable, to "
+              "DIR/<runtime>-footprint.json and .csv"))
+    parser.add_argument(
+        '-n', '--dry-run', action="store_true",
+        help=("Display what would be installed, compared with the previous "
+              "installation, without writing anything"))
+    parser.add_argument(
+        '--dump-plan',
+        help="Write the installation plans to this json file")
+    parser.add_argument(
+        '--state-dir',
+        help=("Where the installation plans applied are recorded, to "
+              "compare with them (default: %s)" % InstallPlan.state_dir))
+    parser.add_argument(
+        '--archive', metavar='FILE',
+        help=("Install the runtime sources directly into this archive "
+              "instead of the output directory: .tar, .tar.gz, .tar.bz2, "
+              ".tar.xz, .tar.zst or .zip. The runtimes are not built "
+              "(incompatible with --build), so the archive contains no "
+              "adalib"))
+    parser.add_argument(
+        '--query', action="store_true",
+        help=("Print the resolved configuration of the runtimes of the "
+              "boards (scenario variables, sources, linker scripts, "
+              "loaders, switches) as json, without installing anything"))
+    parser.add_argument(
+        '--rts-profile',
+        help=("Comma-separated list of the runtime profiles to query "
+              "(default: all the runtimes of the boards)"))
+    parser.add_argument(
+        '--changed-files', metavar='FILE',
+        help=("Only install the runtimes affected by the files listed in "
+              "FILE, one per line ('-' to read them from the standard "
+              "input, e.g. from git diff --name-only). Without target "
+              "board, all the boards are considered"))
+    parser.add_argument(
+        '--daemon', metavar='SOCKET',
+        help=("Run as a server accepting requests on the given Unix socket "
+              "(see rts_client.py)"))
+    parser.add_argument(
+        'target', nargs='*',
         help='List of target boards to generate runtimes for')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if args.daemon is not None:
+        BuildServer(args.daemon, main).serve_forever()
+        return
+    if len(args.target) == 0:
+        if args.changed_files is None:
+            parser.error('no target board specified')
+        args.target = list(ALL_BOARDS)
+    if args.archive is not None and args.build:
+        parser.error('--archive cannot be used with --build: the archive '
+                     'only contains the runtime sources')
+    if not args.build:
+        for option, value in (
+                ('--build-variants', args.build_variants),
+                ('--keep-objects', args.keep_objects or None),
+                ('--object-cache', args.object_cache),
+                ('--compile-times', args.compile_times),
+                ('--stack-report', args.stack_report),
+                ('--footprint-report', args.footprint_report)):
+            if value is not None:
+                parser.error('%s can only be used with --build' % option)
+
+    if args.build_variants is None:
+        variants = [None]
+    elif args.build_variants == 'all':
+        variants = list(BUILD_TYPES)
+    else:
+        variants = args.build_variants.split(',')
+        for variant in variants:
+            if variant not in BUILD_TYPES:
+                parser.error('unknown build variant %s' % variant)
 
     if args.verbose:
         FilesHolder.verbose = True
@@ -214,6 +489,13 @@ def main():
         FilesHolder.link = True
     if args.force:
         Installer.overwrite = True
+    if args.state_dir is not None:
+        InstallPlan.state_dir = os.path.abspath(args.state_dir)
+
+    if args.gen_doc:
+        # Only the boards metadata is needed to generate the documentation:
+        # don't look for the runtime sources
+        FilesHolder.resolve_sources = False
 
     boards = []
 
@@ -222,7 +504,48 @@ def main():
         boards.append(board)
 
     dest = os.path.abspath(args.output)
-    if not os.path.exists(dest):
+
+    # Runtime profiles to install for each board, all by default
+    profiles = [None] * len(boards)
+
+    if args.changed_files is not None:
+        if args.changed_files == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(args.changed_files, 'r') as fp:
+                lines = fp.readlines()
+        changed = [line.strip() for line in lines if len(line.strip()) > 0]
+        index = ReverseIndex(dest, rts_descriptor=args.rts_src_descriptor)
+        for arg, board in zip(args.target, boards):
+            index.add_board(arg, board)
+        affected = index.affected(changed)
+        if len(affected) == 0:
+            print("no runtime affected by the changes")
+            return
+        for arg, profile in affected:
+            print("affected runtime: %s %s" % (arg, profile))
+        selected = []
+        for arg, board in zip(args.target, boards):
+            rts = [profile for a, profile in affected if a == arg]
+            if len(rts) > 0:
+                selected.append((arg, board, rts))
+        args.target = [arg for arg, _, _ in selected]
+        boards = [board for _, board, _ in selected]
+        profiles = [rts for _, _, rts in selected]
+
+    if args.query:
+        rts_profiles = None
+        if args.rts_profile is not None:
+            rts_profiles = args.rts_profile.split(',')
+        result = dict(
+            (arg, query(board, dest, rts_descriptor=args.rts_src_descriptor,
+                        profiles=rts_profiles))
+            for arg, board in zip(args.target, boards))
+        print(json.dumps(result, indent=1, sort_keys=True))
+        return
+
+    if not os.path.exists(dest) and not args.dry_run and \
+            args.archive is None:
         os.makedirs(dest)
 
     # README file generation
@@ -238,34 +561,160 @@ def main():
         # and do nothing else
         return
 
-    if not os.path.exists(dest):
-        os.makedirs(dest)
+    # The installers compute the plans once, whatever is done with them
+    installers = [Installer(board, profiles=rts)
+                  for board, rts in zip(boards, profiles)]
+
+    # Boards with the same configuration (e.g. x86-linux and x86-windows)
+    # install the same runtimes: they are only installed once
+    unique = []
+    installed = {}
+    for arg, installer in zip(args.target, installers):
+        plans = installer.plan(dest, rts_descriptor=args.rts_src_descriptor)
+        same = [installed.get(plan.rts_path) for plan in plans]
+        if len(plans) > 0 and all(
+                prev is not None and prev[1] == plan.as_dict()
+                for prev, plan in zip(same, plans)):
+            print("%s: same runtimes as %s" % (arg, same[0][0]))
+            continue
+        for prev, plan in zip(same, plans):
+            if prev is not None:
+                print("error: %s and %s install different runtimes in %s" %
+                      (prev[0], arg, plan.rts_path))
+                sys.exit(2)
+            installed[plan.rts_path] = (arg, plan.as_dict())
+        unique.append(installer)
+    installers = unique
+
+    if args.dump_plan is not None:
+        plans = []
+        for installer in installers:
+            for plan in installer.plan(
+                    dest, rts_descriptor=args.rts_src_descriptor):
+                plans.append(plan.as_dict())
+        with open(args.dump_plan, 'w') as fp:
+            fp.write(json.dumps(plans, indent=1, sort_keys=True))
+
+    if args.dry_run:
+        for installer in installers:
+            print("runtime sources for %s" % installer.tgt.name)
+            installer.install(
+                dest, rts_descriptor=args.rts_src_descriptor, dry_run=True)
+        return
 
-    # Install the runtimes sources
+    if args.archive is not None:
+        if os.path.exists(args.archive) and not args.force:
+            print("error: %s already exists, use --force to overwrite it" %
+                  args.archive)
+            sys.exit(2)
+        try:
+            archive = RuntimeArchive(args.archive)
+        except ValueError as e:
+            parser.error(str(e))
+        for installer in installers:
+            print("archive runtime sources for %s" % installer.tgt.name)
+            sys.stdout.flush()
+            for plan in installer.plan(
+                    dest, rts_descriptor=args.rts_src_descriptor):
+                archive.add_plan(plan, os.path.relpath(plan.rts_path, dest))
+        archive.close()
+        print("runtimes successfully archived in %s" % args.archive)
+        return
+
+    # Install the runtimes sources. They are first installed and built in
+    # staging directories, and only moved to their final location once
+    # everything succeeded.
     projects = []
-    for board in boards:
-        print("install runtime sources for %s" % board.name)
+    for installer in installers:
+        print("install runtime sources for %s" % installer.tgt.name)
         sys.stdout.flush()
-        installer = Installer(board)
-        projects += installer.install(
+        projects += installer.stage(
             dest, rts_descriptor=args.rts_src_descriptor)
 
     # and build them
     if args.build:
-        for prj in projects:
-            print("building project %s" % prj)
-            sys.stdout.flush()
-            cmd = ['gprbuild', '-j0', '-p', '-P', prj]
-            if args.build_flags is not None:
-                cmd += args.build_flags.split()
-            subprocess.check_call(cmd)
-            # Post-process: remove build artifacts from obj directory
-            cleanup_ext = ('.o', '.ali', '.stdout', '.stderr', '.d', '.lexch')
-            obj_dir = os.path.join(os.path.dirname(prj), 'obj')
-            for fname in os.listdir(obj_dir):
-                _, ext = os.path.splitext(fname)
-                if ext in cleanup_ext:
-                    os.unlink(os.path.join(obj_dir, fname))
+        cc_ids = {}
+        if args.object_cache is not None:
+            try:
+                version = FilesHolder.gcc_version()
+            except IOError:
+                version = None
+            for installer in installers:
+                if installer.compiler not in cc_ids:
+                    cc_ids[installer.compiler] = get_compiler_id(
+                        installer.compiler, version)
+
+        # The first variant is built in the runtime directory, the other
+        # ones in copies of the runtime (sharing the sources through hard
+        # links) with the variant name as suffix.
+        builds = []
+        links = []
+        # Staging directory of the runtime built for each fingerprint
+        built = {}
+        for installer in installers:
+            for staging, plan in installer.staged:
+                fingerprint = plan.fingerprint(
+                    installer.compiler, args.build_flags or '')
+                for variant in variants:
+                    if variant == variants[0]:
+                        rts_staging, rts_plan = staging, plan
+                    else:
+                        rts_staging, rts_plan = installer.stage_variant(
+                            staging, plan, variant.lower())
+                    key = (fingerprint, variant)
+                    if key in built:
+                        # Same libraries as an already built runtime
+                        links.append((built[key], rts_staging, rts_plan))
+                        continue
+                    built[key] = (rts_staging, rts_plan.rts_path)
+                    builds.append((rts_staging, rts_plan.rts_path,
+                                   [os.path.join(rts_staging, prj)
+                                    for prj in rts_plan.projects],
+                                   installer.compiler, variant))
+
+        def build(job):
+            rts_staging, rts_path, rts_projects, compiler, variant = job
+            build_runtime(
+                rts_staging, rts_path, rts_projects, args,
+                compiler=compiler, cc_id=cc_ids.get(compiler),
+                build_type=variant, jobs=jobs, times_log=times_log)
+
+        times_log = None
+        if args.compile_times is not None:
+            times_log = os.path.join(dest, '.compile-times.%d' % os.getpid())
+            if os.path.exists(times_log):
+                os.unlink(times_log)
+        try:
+            if len(variants) == 1:
+                jobs = args.jobs
+                for job in builds:
+                    build(job)
+            else:
+                # The variants are built concurrently, sharing the CPUs
+                from concurrent.futures import ThreadPoolExecutor
+
+                jobs = max(1, (args.jobs or os.cpu_count() or 1) //
+                           len(variants))
+                with ThreadPoolExecutor(max_workers=len(variants)) as pool:
+                    for _ in pool.map(build, builds):
+                        pass
+        finally:
+            if times_log is not None:
+                compile_times_report(times_log, args.compile_times)
+
+        for (src_staging, src_path), rts_staging, rts_plan in links:
+            print("reusing the libraries of %s for %s" % (
+                src_path, rts_plan.rts_path))
+            link_build_outputs(src_staging, rts_staging)
+
+        if args.footprint_report is not None:
+            for installer in installers:
+                for staging, plan in installer.staged:
+                    footprint_report(staging, plan, installer.rts_sources,
+                                     args.footprint_report)
+
+    for installer in installers:
+        installer.commit()
 
     print("runtimes successfully installed in %s" % dest)
 
@@ -1,20 +1,153 @@
-with open("font.hex") as f:
-    num=0
-    for line in f:
-        if num >= 32:
-            print "-- ", num, '\'' + unichr(num) + '\''
-        else:
-            print "-- ", num
-        chr = map (lambda x: int(x, 16), line.split(' '))
-        if True:
-            for v in chr:
-                print '2#{0:08b}#,'.format(v)
-        else:
-            # Rotate
-            for i in range(7):
-                v = 0
-                for j in range(7):
-                    v = v | ((chr[j] >> (7 - i) & 1) << j)
-                print '2#{0:08b}#,'.format(v)
-        num = num + 1
-        print
+"""Generate the font table of the tetris example (fonts.ads) from font.hex.
+
+font.hex has one 8x8 glyph per line, character code order, as 8 rows of
+8 pixels, the leftmost pixel in the most significant bit. The whole file
+is parsed as a single integer, 64 bits per glyph, and the optional
+rotation is done on all the glyphs at once with bit operations.
+
+The glyphs are emitted as 8 bytes, 1 bit per pixel, in the order the
+Oled_Draw calls send them to the display (one byte per display column),
+so that drawing a glyph needs no computation. Only the selected
+characters are emitted (by default the digits used for the score), which
+keeps the table small in flash.
+
+Usage: python font.py [--rotate] [--chars CHARS] > fonts.ads
+"""
+
+import argparse
+import os
+import sys
+
+HEADER = """\
+------------------------------------------------------------------------------
+--                                                                          --
+--                             GNAT EXAMPLE                                 --
+--                                                                          --
+--                    Copyright (C) 2013-2014, AdaCore                      --
+--                                                                          --
+-- GNAT is free software;  you can  redistribute it  and/or modify it under --
+-- terms of the  GNU General Public License as published  by the Free Soft- --
+-- ware  Foundation;  either version 3,  or (at your option) any later ver- --
+-- sion.  GNAT is distributed in the hope that it will be useful, but WITH- --
+-- OUT ANY WARRANTY;  without even the  implied warranty of MERCHANTABILITY --
+-- or FITNESS FOR A PARTICULAR PURPOSE.                                     --
+--                                                                          --
+-- As a special exception under Section 7 of GPL version 3, you are granted --
+-- additional permissions described in the GCC Runtime Library Exception,   --
+-- version 3.1, as published by the Free Software Foundation.               --
+--                                                                          --
+-- You should have received a copy of the GNU General Public License and    --
+-- a copy of the GCC Runtime Library Exception along with this program;     --
+-- see the files COPYING3 and COPYING.RUNTIME respectively.  If not, see    --
+-- <http://www.gnu.org/licenses/>.                                          --
+--                                                                          --
+-- GNAT was originally developed  by the GNAT team at  New York University. --
+-- Extensive contributions were provided by Ada Core Technologies Inc.      --
+--                                                                          --
+------------------------------------------------------------------------------
+"""
+
+
+def read_font(filename):
+    """Returns the number of glyphs of filename, and the glyphs packed in
+    a single integer, the first glyph in the most significant bits"""
+    with open(filename) as f:
+        lines = [line.split() for line in f if line.strip()]
+    for line in lines:
+        assert len(line) == 8, "invalid glyph: %s" % ' '.join(line)
+    return len(lines), int(''.join(''.join(line) for line in lines), 16)
+
+
+def repeat(mask, count):
+    """Returns the 64-bit mask repeated for count glyphs"""
+    ret = 0
+    for _ in range(count):
+        ret = (ret << 64) | mask
+    return ret
+
+
+def transpose(glyphs, count):
+    """Transposes the count 8x8 glyphs: row i becomes column i. The bits are
+    moved by blocks of 1, 2 then 4 pixels, on all the glyphs at once (no
+    bit crosses the boundary of its glyph with these masks)"""
+    for shift, mask in ((7, 0x00AA00AA00AA00AA),
+                        (14, 0x0000CCCC0000CCCC),
+                        (28, 0x00000000F0F0F0F0)):
+        mask = repeat(mask, count)
+        t = (glyphs ^ (glyphs >> shift)) & mask
+        glyphs = glyphs ^ t ^ (t << shift)
+    return glyphs
+
+
+def flip(glyphs, count):
+    """Reverses the order of the rows of the count glyphs"""
+    data = to_rows(glyphs, count)
+    return int(''.join('%02x' % v for i in range(0, len(data), 8)
+                       for v in reversed(data[i:i + 8])), 16)
+
+
+def to_rows(glyphs, count):
+    """Returns the list of the rows of the count glyphs"""
+    text = '%0*x' % (count * 16, glyphs)
+    return [int(text[i:i + 2], 16) for i in range(0, len(text), 2)]
+
+
+def char_name(code):
+    if 32 <= code < 127:
+        return "'%c'" % code
+    return "character %d" % code
+
+
+def ada_table(rows, codes, name):
+    out = [HEADER]
+    out.append('--  Generated by font.py from font.hex, do not edit\n\n')
+    out.append('with Interfaces; use Interfaces;\n\n')
+    out.append('package Fonts is\n')
+    out.append('   type Glyph_Type is array (0 .. 7) of Unsigned_8;\n\n')
+    out.append('   type Font_Type is array (0 .. %d) of Glyph_Type;\n' %
+               (len(codes) - 1))
+    out.append('   %s : constant Font_Type :=\n' % name)
+    out.append('     (\n')
+    glyphs = []
+    for code in codes:
+        glyph = rows[code * 8:code * 8 + 8]
+        glyphs.append('      --  %s\n      (%s)' % (
+            char_name(code),
+            ',\n       '.join('2#{0:08b}#'.format(v) for v in glyph)))
+    out.append(',\n\n'.join(glyphs))
+    out.append('\n     );\n')
+    out.append('end Fonts;\n')
+    return ''.join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--font',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'font.hex'),
+        help='The font file (default: font.hex)')
+    parser.add_argument(
+        '--chars', default='0123456789',
+        help='The characters to emit (default: the digits)')
+    parser.add_argument(
+        '--name', default='Digit_Font',
+        help='The name of the Ada constant (default: Digit_Font)')
+    parser.add_argument(
+        '--rotate', action='store_true',
+        help=('Rotate the glyphs by 90 degrees clockwise, for a display '
+              'mounted the other way'))
+    args = parser.parse_args()
+
+    count, glyphs = read_font(args.font)
+    if args.rotate:
+        glyphs = transpose(flip(glyphs, count), count)
+    codes = [ord(c) for c in args.chars]
+    for code in codes:
+        assert code < count, "no glyph for %s" % char_name(code)
+
+    sys.stdout.write(ada_table(to_rows(glyphs, count), codes, args.name))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,7 @@
 import argparse
 import os
 
-from support.files_holder import FilesHolder
+from support.files_holder import FilesHolder, InstallManifest, copy_files
 from support.rts_sources import SourceTree
 from support.rts_sources.sources import all_scenarios, sources
 
@@ -42,10 +42,26 @@ def main():
         help='installation location for the runtime sources tree')
     parser.add_argument(
         '--rts-profile', choices=['zfp', 'ravenscar-sfp', 'ravenscar-full'],
-        required=True,  help='supported profiles')
+        nargs='+', required=True,
+        help=('supported profiles. When several profiles (or several --os '
+              'values) are given, one descriptor per variant is generated '
+              'in a single pass, named rts-sources-[pikeos-]<profile>.json'))
     parser.add_argument(
         '--pikeos', action="store_true",
-        help="use PikeOS sources")
+        help="use PikeOS sources (same as --os=pikeos)")
+    parser.add_argument(
+        '--os', choices=['bb', 'pikeos'], nargs='+',
+        help=('generate the sources for bare metal, PikeOS or both. When '
+              'both are requested, the PikeOS sources are installed in '
+              '<output-sources>-pikeos'))
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=0,
+        help="number of threads used to copy the sources (0 = one per CPU)")
+    parser.add_argument(
+        '--state-dir',
+        help=('where the manifests of the installed sources are kept, to '
+              'only copy the files that changed on the next run (default: '
+              '%s)' % InstallManifest.state_dir))
 
     args = parser.parse_args()
 
@@ -57,6 +73,8 @@ def main():
         FilesHolder.gccdir = os.path.abspath(args.gcc_dir)
     if args.gnat_dir is not None:
         FilesHolder.gnatdir = os.path.abspath(args.gnat_dir)
+    if args.state_dir is not None:
+        InstallManifest.state_dir = os.path.abspath(args.state_dir)
 
     if args.output is not None:
         dest = os.path.abspath(args.output)
@@ -73,20 +91,74 @@ def main():
     else:
         dest_srcs = os.path.join(dest, 'include', 'rts-sources')
 
+    if args.os is not None:
+        oses = args.os
+    elif args.pikeos:
+        oses = ['pikeos']
+    else:
+        oses = ['bb']
+
+    variants = [(os_name, profile)
+                for os_name in oses for profile in args.rts_profile]
+
     if not os.path.exists(os.path.dirname(dest_json)):
         os.makedirs(os.path.dirname(dest_json))
-    if not os.path.exists(dest_srcs):
-        os.makedirs(dest_srcs)
-
-    # Install the shared runtime sources
-    SourceTree.dest_sources = dest_srcs
-
-    # create the rts sources object. This uses a slightly different set
-    # on pikeos.
-    rts_srcs = SourceTree(
-        is_bb=not args.pikeos, profile=args.rts_profile,
-        rts_sources=sources, rts_scenarios=all_scenarios)
-    rts_srcs.install_tree(dest_json=dest_json, dest_sources=dest_srcs)
+
+    # Install the shared runtime sources.
+    # The sources are installed once per OS, the directories common to the
+    # various profiles being only copied once. Each variant then gets its own
+    # descriptor.
+    jobs = []
+    for os_name, profile in variants:
+        if len(variants) == 1:
+            variant_json = dest_json
+        else:
+            base, ext = os.path.splitext(dest_json)
+            if os_name == 'pikeos':
+                variant_json = '%s-pikeos-%s%s' % (base, profile, ext)
+            else:
+                variant_json = '%s-%s%s' % (base, profile, ext)
+        if os_name == 'pikeos' and len(oses) > 1:
+            variant_srcs = dest_srcs + '-pikeos'
+        else:
+            variant_srcs = dest_srcs
+        jobs.append((os_name, profile, variant_json, variant_srcs))
+
+    def generate(job):
+        os_name, profile, variant_json, variant_srcs = job
+        # create the rts sources object. This uses a slightly different set
+        # on pikeos.
+        rts_srcs = SourceTree(
+            is_bb=os_name == 'bb', profile=profile,
+            rts_sources=sources, rts_scenarios=all_scenarios)
+        rts_srcs.dump_json(variant_json, variant_srcs)
+        return rts_srcs.source_copies(variant_srcs)
+
+    # Each source tree has its own generation context: they can be
+    # generated concurrently. The results are then processed in order.
+    if args.jobs == 1 or len(jobs) < 2:
+        results = [generate(job) for job in jobs]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(
+                max_workers=args.jobs if args.jobs > 0 else None) as pool:
+            results = list(pool.map(generate, jobs))
+
+    copies = {}
+    seen = set()
+    for job, variant_copies in zip(jobs, results):
+        variant_srcs = job[3]
+        if variant_srcs not in copies:
+            copies[variant_srcs] = []
+        for copy in variant_copies:
+            if copy not in seen:
+                seen.add(copy)
+                copies[variant_srcs].append(copy)
+
+    for dest_dir in sorted(copies.keys()):
+        copy_files(copies[dest_dir], jobs=args.jobs,
+                   manifest=InstallManifest(dest_dir))
 
 
 if __name__ == '__main__':
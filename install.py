@@ -9,6 +9,7 @@ import getopt
 import os
 import subprocess
 import sys
+import threading
 
 
 def usage():
@@ -20,6 +21,7 @@ def usage():
     print("By default:")
     print("  Builds and installs all targets for which a compiler is")
     print("  available. The runtimes are installed in the toolchain itself.")
+    print("  The architectures are processed in parallel.")
 
 
 ALL_BSP = {'arm-eabi': ['stm32f4', 'stm32f429disco', 'stm32f469disco',
@@ -32,6 +34,33 @@ ALL_BSP = {'arm-eabi': ['stm32f4', 'stm32f429disco', 'stm32f469disco',
            'aarch64-elf': ['rpi3']}
 
 
+# Cache of the toolchain detection, per architecture
+_TOOLCHAINS = {}
+
+
+def has_toolchain(arch):
+    """Whether a compiler for arch is available in the PATH"""
+    if arch not in _TOOLCHAINS:
+        exe = '%s-gcc' % arch
+        if sys.platform == 'win32':
+            exe += '.exe'
+        _TOOLCHAINS[arch] = False
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            if os.access(os.path.join(path, exe), os.X_OK):
+                _TOOLCHAINS[arch] = True
+                break
+    return _TOOLCHAINS[arch]
+
+
+def _forward_output(arch, proc, lock):
+    """Prints the output of proc, prefixed with the architecture name"""
+    for line in iter(proc.stdout.readline, b''):
+        with lock:
+            sys.stdout.write('[%s] %s' % (arch, line.decode()))
+            sys.stdout.flush()
+    proc.stdout.close()
+
+
 def main():
     try:
         opts, args = getopt.getopt(
@@ -55,16 +84,54 @@ def main():
 
     assert arch is None or arch in ALL_BSP, "unsupported arch %s" % arch
 
-    cmd = [sys.executable, './build_rts.py', '--build', '--force']
-    if prefix is not None:
-        cmd.append('--output=%s' % prefix)
     if arch is None:
-        for k, v in ALL_BSP.items():
-            cmd += v
+        archs = []
+        for k in sorted(ALL_BSP.keys()):
+            if has_toolchain(k):
+                archs.append(k)
+            else:
+                print("no %s compiler found, skipping %s" % (k, k))
     else:
-        cmd += ALL_BSP[arch]
+        if not has_toolchain(arch):
+            print("error: no %s compiler found" % arch)
+            sys.exit(1)
+        archs = [arch]
+
+    # One build_rts.py pipeline per architecture, run in parallel as they
+    # use independent toolchains. The CPUs are shared among them.
+    lock = threading.Lock()
+    env = dict(os.environ)
+    env['PYTHONUNBUFFERED'] = '1'
+    procs = {}
+    readers = []
+    for k in archs:
+        cmd = [sys.executable, './build_rts.py', '--build', '--force']
+        if len(archs) > 1:
+            cmd.append('--jobs=%d' % max(
+                1, (os.cpu_count() or 1) // len(archs)))
+        if prefix is not None:
+            cmd.append('--output=%s' % prefix)
+        cmd += ALL_BSP[k]
+        procs[k] = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        reader = threading.Thread(
+            target=_forward_output, args=(k, procs[k], lock))
+        reader.start()
+        readers.append(reader)
+
+    for reader in readers:
+        reader.join()
+
+    failed = []
+    for k in archs:
+        if procs[k].wait() != 0:
+            failed.append(k)
+            print("error: the installation failed for %s" % k)
+        else:
+            print("runtimes successfully installed for %s" % k)
 
-    subprocess.check_call(cmd)
+    if len(failed) > 0:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,47 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020, AdaCore
+#
+# Compiler wrapper used by build_rts.py when building the runtimes with an
+# object cache (--object-cache) or when timing the compilations
+# (--compile-times). It is called by gprbuild in place of the compiler
+# driver, with the same arguments. The configuration is given in the
+# environment:
+#
+#   RTS_CC_COMPILER: the actual compiler driver (e.g. arm-eabi-gcc)
+#   RTS_CC_ID:       identification of the compiler, part of the cache keys
+#   RTS_CC_CACHE:    the object cache directory
+#   RTS_CC_ROOT:     the directory of the runtime being built
+#   RTS_CC_FINAL:    the location of the runtime in the debug info
+#   RTS_CC_NAME:     the name of the runtime, for the compilation times
+#   RTS_CC_TIMES:    the log file of the compilation times
+
+import os
+import sys
+import time
+
+from support.compile_times import record
+from support.objcache import cached_compile
+
+
+def main():
+    compiler = os.environ.get('RTS_CC_COMPILER', 'gcc')
+    times = os.environ.get('RTS_CC_TIMES')
+    stats = {} if times is not None else None
+    start = time.time()
+    status = cached_compile(
+        compiler, sys.argv[1:],
+        cache_dir=os.environ.get('RTS_CC_CACHE'),
+        root=os.environ.get('RTS_CC_ROOT'),
+        compiler_id=os.environ.get('RTS_CC_ID', compiler),
+        final_root=os.environ.get('RTS_CC_FINAL'),
+        stats=stats)
+    if times is not None and stats['source'] is not None:
+        record(times, os.path.basename(stats['source']),
+               os.environ.get('RTS_CC_NAME', ''),
+               time.time() - start, stats['cached'])
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
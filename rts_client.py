@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020, AdaCore
+#
+# Thin client of the build_rts.py server (build_rts.py --daemon SOCKET).
+# It takes the same arguments as build_rts.py, and only imports the
+# standard modules it needs so that it starts quickly.
+#
+# usage: rts_client.py [--socket SOCKET] <build_rts.py arguments>
+#
+# The socket can also be given with the BUILD_RTS_SOCKET environment
+# variable.
+
+import json
+import os
+import socket
+import sys
+
+
+def main():
+    argv = sys.argv[1:]
+    path = os.environ.get('BUILD_RTS_SOCKET')
+    if len(argv) > 1 and argv[0] == '--socket':
+        path = argv[1]
+        argv = argv[2:]
+    elif len(argv) > 0 and argv[0].startswith('--socket='):
+        path = argv[0][len('--socket='):]
+        argv = argv[1:]
+    if path is None:
+        print("error: no server socket: use --socket or BUILD_RTS_SOCKET")
+        sys.exit(2)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        print("error: cannot connect to %s: %s" % (path, str(e)))
+        sys.exit(2)
+
+    request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    sock.sendall(json.dumps(request).encode() + b'\n')
+
+    # The output is forwarded as is, up to the NUL character that precedes
+    # the exit status
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    tail = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data = tail + chunk
+        pos = data.find(b'\0')
+        if pos >= 0:
+            out.write(data[:pos])
+            tail = data[pos:]
+            continue
+        out.write(data)
+        out.flush()
+        tail = b''
+    out.flush()
+    sock.close()
+
+    if not tail.startswith(b'\0'):
+        print("error: connection to the server lost")
+        sys.exit(2)
+    sys.exit(int(tail[1:].strip() or 1))
+
+
+if __name__ == '__main__':
+    main()
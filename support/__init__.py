@@ -1,5 +1,6 @@
 import sys
 import os
+import threading
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
@@ -46,6 +47,33 @@ def readfile(filename):
     return res
 
 
+def write_if_changed(filename, content):
+    """Writes content to filename, unless the file already has this content.
+
+    CONTENT is either a string, or bytes for binary files. Returns True if
+    the file was written. Leaving identical files untouched preserves their
+    timestamp for the tools working incrementally.
+    The new content is written to a temporary file then renamed, so that
+    filename is replaced atomically: readers see either the old or the new
+    content, never a partial file."""
+    binary = isinstance(content, bytes) and not is_string(content)
+    if os.path.isfile(filename):
+        with open(filename, 'rb' if binary else 'r') as fp:
+            if fp.read() == content:
+                return False
+    tmp = '%s.%d.%d.tmp' % (
+        filename, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(tmp, 'wb' if binary else 'w') as fp:
+            fp.write(content)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return True
+
+
 def is_string(arg):
     """Handles differencies in behavior between python2 and 3 concerning strings
 
@@ -0,0 +1,138 @@
+"""Installation of runtimes directly into an archive.
+
+Instead of creating the runtime trees on disk (see execute_plan), the
+installation plans are streamed into a tar archive (possibly compressed
+with gzip, bzip2, xz or zstd) or a zip archive, for packaging. The
+generated files are written from memory, and the sources shared by
+several runtimes are only stored once: the next occurrences are stored as
+hard links in tar archives (zip archives have no hard links).
+
+The archive only contains the runtime sources: the runtimes are not built,
+and the records of the installations (manifests, applied plans) are kept
+outside of the runtime trees, so they are never part of it.
+"""
+
+import hashlib
+import io
+import os
+import subprocess
+import tarfile
+import time
+import zipfile
+
+from support.files_holder import FilesHolder
+
+
+class RuntimeArchive(object):
+    """Archive being filled with runtimes"""
+
+    # tarfile modes, by archive suffix
+    tar_modes = (('.tar', 'w|'),
+                 ('.tar.gz', 'w|gz'), ('.tgz', 'w|gz'),
+                 ('.tar.bz2', 'w|bz2'),
+                 ('.tar.xz', 'w|xz'), ('.txz', 'w|xz'))
+
+    # compressed with the zstd command
+    zstd_suffixes = ('.tar.zst', '.tzst')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._proc = None
+        self._fp = None
+        self._tar = None
+        self._zip = None
+        # arcname of the files already stored, by content hash, mode and
+        # modification time (a hard link shares all of them)
+        self._stored = {}
+        self._dirs = set()
+        self._mtime = int(time.time())
+
+        if filename.endswith('.zip'):
+            self._zip = zipfile.ZipFile(
+                filename, 'w', compression=zipfile.ZIP_DEFLATED)
+            return
+
+        if filename.endswith(self.zstd_suffixes):
+            self._fp = open(filename, 'wb')
+            self._proc = subprocess.Popen(
+                ['zstd', '-q', '-c'], stdin=subprocess.PIPE, stdout=self._fp)
+            self._tar = tarfile.open(fileobj=self._proc.stdin, mode='w|')
+            return
+
+        for suffix, mode in self.tar_modes:
+            if filename.endswith(suffix):
+                self._tar = tarfile.open(filename, mode=mode)
+                return
+        raise ValueError('unsupported archive format: %s' % filename)
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        else:
+            self._tar.close()
+        if self._proc is not None:
+            self._proc.stdin.close()
+            status = self._proc.wait()
+            self._fp.close()
+            if status != 0:
+                raise IOError('zstd failed with status %d' % status)
+
+    def _add_dir(self, arcname):
+        if arcname in self._dirs:
+            return
+        self._dirs.add(arcname)
+        if self._zip is not None:
+            info = zipfile.ZipInfo(arcname + '/',
+                                   time.localtime(self._mtime)[:6])
+            info.external_attr = (0o40755 << 16) | 0x10
+            self._zip.writestr(info, b'')
+        else:
+            info = tarfile.TarInfo(arcname)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = self._mtime
+            self._tar.addfile(info)
+
+    def _add_data(self, arcname, data, mode, mtime):
+        """Stores data as arcname, or a link to an identical file already
+        stored"""
+        key = (hashlib.sha1(data).hexdigest(), mode, mtime)
+        if self._zip is not None:
+            info = zipfile.ZipInfo(arcname, time.localtime(mtime)[:6])
+            info.external_attr = (0o100000 | mode) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self._zip.writestr(info, data)
+            return
+
+        info = tarfile.TarInfo(arcname)
+        info.mode = mode
+        info.mtime = mtime
+        if key in self._stored:
+            info.type = tarfile.LNKTYPE
+            info.linkname = self._stored[key]
+            self._tar.addfile(info)
+            if FilesHolder.verbose:
+                print("same file, link: %s, %s" % (info.linkname, arcname))
+            return
+        self._stored[key] = arcname
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def add_plan(self, plan, root):
+        """Stores the runtime of plan, in the directory root of the archive
+        """
+        self._add_dir(root)
+        for rel_dir in sorted(plan.directories):
+            if rel_dir != '':
+                self._add_dir(os.path.join(root, rel_dir))
+
+        for rel, src in sorted(plan.files.items()):
+            with open(src, 'rb') as fp:
+                data = fp.read()
+            st = os.stat(src)
+            self._add_data(os.path.join(root, rel), data,
+                           st.st_mode & 0o777, int(st.st_mtime))
+
+        for rel, content in sorted(plan.generated.items()):
+            self._add_data(os.path.join(root, rel), content.encode(),
+                           0o644, self._mtime)
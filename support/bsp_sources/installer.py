@@ -1,61 +1,436 @@
-from support import readfile, getdatafilepath
+from support import readfile, getdatafilepath, write_if_changed
 from support.bsp_sources.target import Target
-from support.files_holder import _copy
+from support.files_holder import FilesHolder, InstallManifest, \
+    copy_files, file_hash, same_content
+from support.rts_sources.index import RTSSourcesIndex
 
+import copy
+import hashlib
 import json
 import os
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+
+
+class InstallPlan(object):
+    """Complete description of a runtime installation.
+
+    The plan lists every directory, every file to copy (with its source) and
+    every generated file (with its content) of the runtime. It is computed
+    without writing anything on disk, so it can be inspected (--dry-run),
+    serialized, or compared with the plan applied previously, before being
+    applied by execute_plan.
+
+    All paths are relative to the runtime directory."""
+
+    # Where the plans applied in the runtime directories are recorded. This
+    # is not in the runtime directories themselves, as the plans hold paths
+    # of the build host.
+    state_dir = os.path.join(
+        os.path.dirname(InstallManifest.state_dir), 'plans')
+
+    # Directories that are not used when building the runtime libraries
+    link_only_dirs = ('ld', 'ld_user')
+
+    # Files that are not used when building the runtime libraries
+    doc_files = ('README', )
+
+    def __init__(self, rts_name, rts_path):
+        self.rts_name = rts_name
+        self.rts_path = rts_path
+        self.directories = []
+        self.files = {}
+        self.generated = {}
+        self.projects = []
+
+    def add_directory(self, rel_dir):
+        if rel_dir not in self.directories:
+            self.directories.append(rel_dir)
+
+    def add_file(self, src, rel_dir, basename=None):
+        """Plans the copy of src in rel_dir"""
+        if basename is None:
+            basename = os.path.basename(src)
+        rel = os.path.join(rel_dir, basename)
+        self.add_directory(rel_dir)
+
+        if rel in self.files:
+            prev = self.files[rel]
+            if prev != src and not same_content(prev, src):
+                print("runtime file " + rel + " already exists")
+                print("cannot install " + src)
+                sys.exit(5)
+            if FilesHolder.verbose:
+                print("same file, skip: " + src + ", " + rel)
+            return
+        self.files[rel] = src
+
+    def add_files(self, flist, rel_dir):
+        """Plans the copy of a list of files or directories (non recursive)
+        in rel_dir"""
+        if len(flist) == 0:
+            return
+        self.add_directory(rel_dir)
+        for item in flist:
+            if os.path.isfile(item):
+                self.add_file(item, rel_dir)
+            else:
+                for fname in sorted(os.listdir(item)):
+                    fsrc = os.path.join(item, fname)
+                    if os.path.isfile(fsrc):
+                        self.add_file(fsrc, rel_dir)
+
+    def add_pairs(self, pairs, rel_dir):
+        """Plans the installation of a list of FilePairs in rel_dir"""
+        self.add_directory(rel_dir)
+        for pair in pairs:
+            self.add_file(pair.src, rel_dir, pair.dst)
+
+    def add_generated(self, rel, content):
+        """Plans the generation of rel, with the given content"""
+        self.add_directory(os.path.dirname(rel))
+        self.generated[rel] = content
+
+    def add_project(self, rel):
+        self.projects.append(rel)
+
+    def basenames(self, rel_dir):
+        """The sorted list of files planned in rel_dir"""
+        ret = []
+        for rel in list(self.files.keys()) + list(self.generated.keys()):
+            if os.path.dirname(rel) == rel_dir:
+                ret.append(os.path.basename(rel))
+        return sorted(ret)
 
+    @property
+    def project_paths(self):
+        return [os.path.join(self.rts_path, prj) for prj in self.projects]
+
+    def as_dict(self):
+        """Serializable form of the plan.
+
+        Generated files are represented by the sha1 of their content."""
+        generated = {}
+        for rel, content in self.generated.items():
+            generated[rel] = hashlib.sha1(content.encode()).hexdigest()
+        return {'rts_name': self.rts_name,
+                'rts_path': self.rts_path,
+                'directories': sorted(d for d in self.directories if d != ''),
+                'files': dict(self.files),
+                'generated': generated,
+                'projects': list(self.projects)}
+
+    def fingerprint(self, *extra):
+        """Returns a hash of everything the build of the runtime libraries
+        depends on: the content of the sources, the projects and the
+        compiler configuration. Runtimes with the same fingerprint produce
+        the same libraries.
+
+        EXTRA are additional strings to take into account (e.g. the
+        compiler, the build flags).
+
+        The location of the runtime is not part of it: the debug info of
+        the libraries refers to the sources with a path independent of the
+        runtime directory (see build_rts.py)."""
+        h = hashlib.sha1()
+        for item in extra:
+            h.update(item.encode() + b'\0')
+        for rel in sorted(self.files):
+            if rel.split(os.sep)[0] in self.link_only_dirs or \
+                    rel in self.doc_files:
+                continue
+            h.update(rel.encode() + b'\0')
+            h.update(file_hash(self.files[rel]).encode() + b'\0')
+        for rel in sorted(self.generated):
+            content = self.generated[rel]
+            if rel == 'runtime.xml':
+                # Only the compiler settings matter, not the link ones
+                start = content.find('package Compiler is')
+                end = content.find('end Compiler;')
+                content = content[start:end]
+            h.update(rel.encode() + b'\0')
+            h.update(content.encode() + b'\0')
+        h.update('\0'.join(self.projects).encode())
+        return h.hexdigest()
 
-def copy_file(src, dest):
-    if os.path.isdir(dest):
-        dest = os.path.join(dest, os.path.basename(src))
-    _copy(src, dest)
-
-
-def install_files(flist, dest):
-    if len(flist) == 0:
+    @property
+    def record_path(self):
+        """The file recording the plan applied in rts_path"""
+        key = hashlib.sha1(
+            os.path.abspath(self.rts_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.state_dir, key + '.json')
+
+    def record(self):
+        """Records the plan as the one applied in rts_path"""
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir, exist_ok=True)
+        write_if_changed(self.record_path,
+                         json.dumps(self.as_dict(), indent=1, sort_keys=True))
+
+    def previous(self):
+        """Returns the serialized plan applied last time in rts_path, if any
+        """
+        record = self.record_path
+        if not os.path.isfile(record):
+            return None
+        try:
+            with open(record, 'r') as fp:
+                return json.load(fp)
+        except ValueError:
+            return None
+
+    def diff(self, previous):
+        """Compares the plan with a previously applied one (as returned by
+        as_dict).
+
+        Returns the (changed, removed) tuple of lists of relative paths."""
+        current = self.as_dict()
+        changed = []
+        removed = []
+        for kind in ('files', 'generated'):
+            for rel, val in current[kind].items():
+                if previous[kind].get(rel) != val:
+                    changed.append(rel)
+            for rel in previous[kind]:
+                if rel not in current[kind]:
+                    removed.append(rel)
+        return sorted(changed), sorted(removed)
+
+
+def execute_plan(plan, jobs=0, root=None, base=None):
+    """Applies plan: creates the runtime directory and its content.
+
+    ROOT is the directory where the runtime is created, by default the
+    runtime directory of the plan.
+    BASE, if set, is a previous installation of the runtime: its files that
+    are identical to the planned ones are hard linked instead of copied."""
+    if root is None:
+        root = plan.rts_path
+    for rel_dir in [''] + sorted(plan.directories):
+        full = os.path.join(root, rel_dir)
+        if not os.path.isdir(full):
+            os.makedirs(full)
+
+    copies = []
+    for rel, src in sorted(plan.files.items()):
+        dst = os.path.join(root, rel)
+        if base is not None and not FilesHolder.link and \
+                _link_from_base(os.path.join(base, rel), dst, src=src):
+            continue
+        copies.append((src, dst))
+    copy_files(copies, jobs=jobs)
+
+    # Generated files (runtime.xml, projects, configuration files...) that
+    # did not change are taken from the previous installation with their
+    # timestamp: gprbuild would otherwise consider all the units out of
+    # date.
+    for rel, content in plan.generated.items():
+        dst = os.path.join(root, rel)
+        if base is not None and \
+                _link_from_base(os.path.join(base, rel), dst, content=content):
+            continue
+        with open(dst, 'w') as fp:
+            fp.write(content)
+
+
+def _link_from_base(old, dst, src=None, content=None):
+    """Hard links old to dst if it has the content of the file src, or the
+    given content. Returns whether the link was done.
+
+    The new tree never modifies such files in place, so they can be shared
+    with the previous installation."""
+    if not os.path.isfile(old) or os.path.islink(old):
+        return False
+    if src is not None:
+        if not same_content(src, old):
+            return False
+    elif readfile(old) != content:
+        return False
+    try:
+        os.link(old, dst)
+    except OSError:
+        # No hard links on this filesystem: copy, preserving the timestamp
+        try:
+            shutil.copy2(old, dst)
+        except (IOError, OSError):
+            return False
+    if FilesHolder.verbose:
+        print("unchanged, link: " + old + ", " + dst)
+    return True
+
+
+def _rename_exchange(path1, path2):
+    """Atomically exchanges path1 and path2 (Linux renameat2). Returns False
+    if not supported"""
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return False
+    AT_FDCWD = -100
+    RENAME_EXCHANGE = 2
+    ret = renameat2(AT_FDCWD, path1.encode(), AT_FDCWD, path2.encode(),
+                    RENAME_EXCHANGE)
+    return ret == 0
+
+
+def _remove_tree_in_background(path):
+    """Removes path in a separate thread. The interpreter waits for its
+    completion before exiting."""
+    thread = threading.Thread(
+        target=shutil.rmtree, args=(path, ), kwargs={'ignore_errors': True})
+    thread.start()
+    return thread
+
+
+def swap_in(staging, rts_path):
+    """Replaces rts_path with the staging directory.
+
+    When supported this is atomic: rts_path is always either the previous
+    or the new runtime. The previous runtime is removed in the background.
+    """
+    if not os.path.exists(rts_path):
+        os.rename(staging, rts_path)
         return
-    basenames = []
-    if not os.path.isdir(dest):
-        os.makedirs(dest)
-    for item in flist:
-        if os.path.isfile(item):
-            copy_file(item, dest)
-            basenames.append(os.path.basename(item))
-
+    # The previous runtime is removed under a unique name, so that a new
+    # staging directory of the same runtime can be created meanwhile
+    old = tempfile.mkdtemp(
+        prefix='.%s.old.' % os.path.basename(rts_path),
+        dir=os.path.dirname(rts_path))
+    if _rename_exchange(staging, rts_path):
+        os.rename(staging, old)
+    else:
+        # Not atomic: rts_path is missing between the two renames
+        os.rename(rts_path, old)
+        os.rename(staging, rts_path)
+    _remove_tree_in_background(old)
+
+
+def report_plan(plan):
+    """Displays a summary of plan, compared with the plan previously applied
+    in the same runtime directory"""
+    print("runtime %s in %s:" % (plan.rts_name, plan.rts_path))
+    print("  %d directories, %d copied files, %d generated files" % (
+        len(plan.directories), len(plan.files), len(plan.generated)))
+    previous = plan.previous()
+    if previous is None:
+        if os.path.exists(plan.rts_path):
+            print("  no previous installation record: full reinstall")
         else:
-            for fname in os.listdir(item):
-                fsrc = os.path.join(item, fname)
-                if os.path.isfile(fsrc):
-                    copy_file(fsrc, dest)
-                    basenames.append(fname)
-    return basenames
+            print("  new installation")
+        return
+    changed, removed = plan.diff(previous)
+    if len(changed) == 0 and len(removed) == 0:
+        print("  up-to-date")
+        return
+    for rel in changed:
+        print("  update %s" % rel)
+    for rel in removed:
+        print("  remove %s" % rel)
 
 
 class SharedRTSSources(object):
+    # Content of the descriptors already loaded, with the (size, mtime) of
+    # the file when loaded, so that long-lived processes only load them
+    # once
+    _loaded = {}
+
     def __init__(self, json_file):
         self._pwd = os.path.dirname(json_file)
-        with open(json_file, 'r') as fp:
-            cnt = fp.read()
-        self.cnt = json.loads(cnt)
+        self._json_file = json_file
+        st = os.stat(json_file)
+        stamp = (st.st_size, st.st_mtime_ns)
+        cached = SharedRTSSources._loaded.get(json_file)
+        if cached is not None and cached[0] == stamp:
+            self._data = cached[1]
+        else:
+            # The json content is only parsed when the descriptor has no
+            # valid index (see support.rts_sources.index), or when the
+            # tree itself is needed.
+            self._data = {'index': RTSSourcesIndex.load(json_file),
+                          'cnt': None}
+            SharedRTSSources._loaded[json_file] = (stamp, self._data)
 
     @property
     def install_dir(self):
         return self._pwd
 
-    def scenarios(self, lib):
-        assert lib in self.cnt, \
+    @property
+    def json_file(self):
+        return self._json_file
+
+    @property
+    def cnt(self):
+        """The content of the json descriptor"""
+        if self._data['cnt'] is None:
+            with open(self._json_file, 'r') as fp:
+                self._data['cnt'] = json.loads(fp.read())
+        return self._data['cnt']
+
+    @property
+    def index(self):
+        return self._data['index']
+
+    @property
+    def libs(self):
+        if self.index is not None:
+            return sorted(self.index.libs.keys())
+        return sorted(self.cnt.keys())
+
+    def _check_lib(self, lib):
+        assert lib in self.libs, \
             "The runtime sources don't provide support for lib%s" % lib
+
+    def scenarios(self, lib):
+        self._check_lib(lib)
+        if self.index is not None:
+            return self.index.scenarios(lib)
         return self.cnt[lib]['scenarios']
 
     def sources(self, lib):
-        assert lib in self.cnt, \
-            "The runtime sources don't provide support for lib%s" % lib
+        self._check_lib(lib)
         return self.SharedSourcesItem(self.cnt[lib]['sources'], self._pwd)
 
+    def source_dirs(self, lib, scenarios):
+        """The list of source directories of lib selected by the scenario
+        variables"""
+        self._check_lib(lib)
+        if self.index is not None:
+            return self.index.source_dirs(lib, scenarios)
+
+        def walk(item):
+            ret = item.source_dirs
+            for scenario, condition, sub in item:
+                if scenario in scenarios and \
+                        scenarios[scenario] == condition:
+                    ret += walk(sub)
+            return ret
+        return walk(self.sources(lib))
+
+    def directories(self, lib):
+        """The list of (directory, conditions) of all the source directories
+        of lib, conditions being the list of var:value conditions that
+        select the directory, outermost first"""
+        self._check_lib(lib)
+        if self.index is not None:
+            return self.index.directories(lib)
+
+        ret = []
+
+        def walk(item, conditions):
+            for d in item.source_dirs:
+                ret.append((d, conditions))
+            for scenario, condition, sub in item:
+                walk(sub, conditions + ['%s:%s' % (scenario, condition)])
+        walk(self.sources(lib), [])
+        return ret
+
     class SharedSourcesItem(object):
         def __init__(self, raw_data, base):
             self.cnt = raw_data
@@ -82,14 +457,37 @@ class Installer(object):
     """Responsible for generating the BSP source tree and the RTS project"""
     overwrite = False
 
-    def __init__(self, target):
+    # Files and directories produced by the build of a runtime
+    build_outputs = ('obj', 'adalib', 'ada_target_properties')
+
+    # Descriptors found with gprls, per target
+    _gprls_descriptors = {}
+
+    def __init__(self, target, profiles=None):
         assert isinstance(target, Target), "invalid target argument"
         self.tgt = target
+        # If set, the runtime profiles to install, by default all the
+        # runtimes of the target
+        self.profiles = profiles
+        # (staging directory, plan) of the runtimes installed by stage, not
+        # committed yet
+        self._staged = []
+        # The runtime sources descriptor used by the last call to plan
+        self.rts_sources = None
+        # The plans computed, by (destination, runtime sources descriptor)
+        self._plans = {}
 
     @property
     def is_native(self):
         return self.tgt.target is None
 
+    @property
+    def compiler(self):
+        """The compiler driver used to build the runtimes"""
+        if self.is_native:
+            return 'gcc'
+        return '%s-gcc' % self.tgt.target
+
     def _find_rts_sources(self, destination, descriptor):
         """Find the runtime sources and the json file that describes them.
         """
@@ -106,6 +504,11 @@ class Installer(object):
             if os.path.exists(fname):
                 ret = os.path.normpath(fname)
 
+        if ret is None and self.tgt.target in Installer._gprls_descriptors:
+            ret = Installer._gprls_descriptors[self.tgt.target]
+            if not os.path.exists(ret):
+                ret = None
+
         if ret is None:
             # Finally: Use gprls to retrieve gnat installation path and see
             # if we find the file somewhere in the project search path
@@ -132,51 +535,42 @@ class Installer(object):
                 tentative = os.path.join(line, rts_json_file)
                 if os.path.exists(tentative):
                     ret = os.path.normpath(tentative)
+                    Installer._gprls_descriptors[self.tgt.target] = ret
                     break
         assert ret is not None, "Cannot find %s" % rts_json_file
         return SharedRTSSources(ret)
 
-    def _get_rts_dirs(self, rts_source_item, scenarios):
-        """Recursively look for runtime source dirs to include in the runtime.
+    def rts_path(self, destination, rts_base_name):
+        """The installation directory of a runtime in destination"""
+        if self.tgt.is_native or self.tgt.is_pikeos:
+            rtsname = 'rts-%s' % rts_base_name
+        else:
+            rtsname = '%s-%s' % (rts_base_name, self.tgt.name)
+        return os.path.join(destination, rtsname)
 
-        This uses the scenario variables defined by the BSP to only use the
-        proper folders in the runtime sources.
-        """
-        ret = rts_source_item.source_dirs
-        for scenario, condition, sub in rts_source_item:
-            if scenario in scenarios and \
-                    scenarios[scenario] == condition:
-                ret += self._get_rts_dirs(sub, scenarios)
-        return ret
+    def plan(self, destination, rts_descriptor=None):
+        """Computes the installation plans of the target's runtimes.
 
-    def install(self, destination, rts_descriptor=None):
-        # Build target directories
+        Nothing is written on disk. Returns the list of InstallPlan objects,
+        one per runtime. The plans are only computed once per destination."""
         destination = os.path.abspath(destination)
-        if not os.path.exists(destination):
-            os.mkdir(destination)
+        key = (destination, rts_descriptor)
+        if key in self._plans:
+            self.rts_sources = self._plans[key][0]
+            return self._plans[key][1]
 
         # Retrieve runtime sources
         runtime_sources = self._find_rts_sources(destination, rts_descriptor)
-        projects = []
+        self.rts_sources = runtime_sources
+        plans = []
 
         for rts_base_name, rts_obj in self.tgt.runtimes.items():
-            if self.tgt.is_native or self.tgt.is_pikeos:
-                rtsname = 'rts-%s' % rts_base_name
-            else:
-                rtsname = '%s-%s' % (rts_base_name, self.tgt.name)
-            rts_path = os.path.join(destination, rtsname)
-            if os.path.exists(rts_path):
-                if not self.overwrite:
-                    print("ERROR: a runtime already exists in")
-                    print("  %s" % rts_path)
-                    print("remove the runtime, use a different installation"
-                          " path or use --force to overwrite")
-                    sys.exit(1)
-                else:
-                    # remove everything there
-                    print("WARNING: replacing a previously existing runtime")
-                    print("  %s" % rts_path)
-                    shutil.rmtree(rts_path)
+            if self.profiles is not None and \
+                    rts_base_name not in self.profiles:
+                continue
+            plan = InstallPlan(
+                rts_base_name, self.rts_path(destination, rts_base_name))
+            plans.append(plan)
             scenario_vars = rts_obj.rts_vars
 
             if 'ravenscar' in rts_base_name:
@@ -193,8 +587,7 @@ class Installer(object):
             # Placeholder for user-defined sources
             user_libs = ['%s_user' % d for d in libs]
             for lib in user_libs:
-                dest = os.path.join(rts_path, lib)
-                os.makedirs(dest)
+                plan.add_directory(lib)
 
             # GNARL extra directory for ravenscar-full:
             # With the ravenscar full, we can't split properly libgnat
@@ -207,29 +600,23 @@ class Installer(object):
             # still try to link with it when tasking is used, so we need to
             # have one available).
             if rts_base_name == 'ravenscar-full':
-                dest = os.path.join(rts_path, 'gnarl_empty')
-                os.makedirs(dest)
-                with open(os.path.join(dest, 'empty.c'), 'w') as fp:
-                    fp.write('\n')
+                plan.add_generated(os.path.join('gnarl_empty', 'empty.c'),
+                                   '\n')
 
-            # Now copy the full set of sources to use for the runtime
+            # Now the full set of sources to use for the runtime
             langs = {}
             for lib in libs:
                 langs[lib] = ['Ada']
-                dest = os.path.join(rts_path, lib)
-                # Install sources from the shared rts sources
-                dirs = self._get_rts_dirs(
-                    runtime_sources.sources(lib), scenario_vars)
-                install_files(dirs, dest)
-                # and install sources from the BSP
-                for pair in self.tgt.get_sources(lib):
-                    pair.install(dest)
+                # Sources from the shared rts sources
+                dirs = runtime_sources.source_dirs(lib, scenario_vars)
+                plan.add_files(dirs, lib)
+                # and sources from the BSP
+                plan.add_pairs(self.tgt.get_sources(lib), lib)
                 if lib in rts_obj.dirs:
-                    for pair in rts_obj.dirs[lib]:
-                        pair.install(dest)
+                    plan.add_pairs(rts_obj.dirs[lib], lib)
                 # Check the list of languages used there, to produce the proper
                 # _build.gpr project.
-                for fname in os.listdir(dest):
+                for fname in plan.basenames(lib):
                     _, ext = os.path.splitext(fname)
                     if 'C' not in langs[lib] and (ext == '.c' or ext == '.h'):
                         langs[lib].append('C')
@@ -238,33 +625,26 @@ class Installer(object):
                     if 'Asm_Cpp' not in langs[lib] and ext == '.S':
                         langs[lib].append('Asm_Cpp')
 
-            # Copy the ld scripts
+            # The ld scripts
             if len(self.tgt.ld_scripts) > 0:
-                dest = os.path.join(rts_path, 'ld')
-                if not os.path.isdir(dest):
-                    os.makedirs(dest)
-                for script in self.tgt.ld_scripts:
-                    script.install(dest)
+                plan.add_pairs(self.tgt.ld_scripts, 'ld')
             # Add user-defined placeholder for ld scripts
-            dest = os.path.join(rts_path, 'ld_user')
-            if not os.path.isdir(dest):
-                os.makedirs(dest)
+            plan.add_directory('ld_user')
 
-            # Install target and run-time specific configuration files
+            # Target and run-time specific configuration files
             for name, content in self.tgt.config_files.items():
-                with open(os.path.join(rts_path, name), 'w') as fp:
-                    fp.write(content)
+                plan.add_generated(name, content)
             for name, content in rts_obj.config_files.items():
-                with open(os.path.join(rts_path, name), 'w') as fp:
-                    fp.write(content)
-            with open(os.path.join(rts_path, 'runtime.xml'), 'w') as fp:
-                fp.write(self.tgt.dump_runtime_xml(rts_base_name, rts_obj))
-            with open(os.path.join(rts_path, 'ada_source_path'), 'w') as fp:
-                # Make sure the user-defined sources come first to preempt
-                # default sources when needed
-                fp.write('%s\n' % '\n'.join(list(user_libs) + list(libs)))
-            with open(os.path.join(rts_path, 'ada_object_path'), 'w') as fp:
-                fp.write('adalib\n')
+                plan.add_generated(name, content)
+            plan.add_generated(
+                'runtime.xml',
+                self.tgt.dump_runtime_xml(rts_base_name, rts_obj))
+            # Make sure the user-defined sources come first to preempt
+            # default sources when needed
+            plan.add_generated(
+                'ada_source_path',
+                '%s\n' % '\n'.join(list(user_libs) + list(libs)))
+            plan.add_generated('ada_object_path', 'adalib\n')
 
             # And generate the project files used to build the rts
 
@@ -273,38 +653,27 @@ class Installer(object):
                 build_flags[f] = '",\n        "'.join(rts_obj.build_flags[f])
             cnt = readfile(getdatafilepath('target_options.gpr'))
             # Format
-            cnt = cnt.format(**build_flags)
-            # Write
-            with open(os.path.join(rts_path, 'target_options.gpr'), 'w') as fp:
-                fp.write(cnt)
-
-            runtime_build = os.path.join(rts_path, "runtime_build.gpr")
-            runtime_build_tmpl = getdatafilepath('runtime_build.gpr.in')
-            with open(runtime_build_tmpl, 'r') as fp:
-                template = fp.read()
-            with open(runtime_build, 'w') as fp:
-                if self.is_native:
-                    target_directive = ''
-                else:
-                    target_directive = 'for Target use "%s";' % self.tgt.target
-                source_dirs = ['gnat_user', 'gnat']
-                languages = langs['gnat']
-                if rts_base_name == 'ravenscar-full':
-                    # ravenscar-full: combine libgnat and libgnarl
-                    source_dirs.extend(['gnarl_user', 'gnarl'])
-                    for lang in langs['gnarl']:
-                        if lang not in languages:
-                            languages.append(lang)
-                fp.write(template.format(
-                    target_directive=target_directive,
-                    source_dirs='", "'.join(source_dirs),
-                    languages='", "'.join(languages)))
+            plan.add_generated('target_options.gpr', cnt.format(**build_flags))
+
+            template = readfile(getdatafilepath('runtime_build.gpr.in'))
+            if self.is_native:
+                target_directive = ''
+            else:
+                target_directive = 'for Target use "%s";' % self.tgt.target
+            source_dirs = ['gnat_user', 'gnat']
+            languages = langs['gnat']
+            if rts_base_name == 'ravenscar-full':
+                # ravenscar-full: combine libgnat and libgnarl
+                source_dirs.extend(['gnarl_user', 'gnarl'])
+                for lang in langs['gnarl']:
+                    if lang not in languages:
+                        languages.append(lang)
+            plan.add_generated('runtime_build.gpr', template.format(
+                target_directive=target_directive,
+                source_dirs='", "'.join(source_dirs),
+                languages='", "'.join(languages)))
             if 'gnarl' in libs:
-                ravenscar_build = os.path.join(rts_path, "ravenscar_build.gpr")
-                ravenscar_build_tmpl = getdatafilepath(
-                    "ravenscar_build.gpr.in")
-                with open(ravenscar_build_tmpl, 'r') as fp:
-                    template = fp.read()
+                template = readfile(getdatafilepath("ravenscar_build.gpr.in"))
                 if rts_base_name != 'ravenscar-full':
                     source_dirs = ['gnarl_user', 'gnarl']
                     languages = langs['gnarl']
@@ -314,26 +683,161 @@ class Installer(object):
                     # lib
                     source_dirs = ['gnarl_empty']
                     languages = ['C']
-                with open(ravenscar_build, 'w') as fp:
-                    fp.write(template.format(
-                        source_dirs='", "'.join(source_dirs),
-                        languages='", "'.join(languages)))
-                projects.append(ravenscar_build)
+                plan.add_generated('ravenscar_build.gpr', template.format(
+                    source_dirs='", "'.join(source_dirs),
+                    languages='", "'.join(languages)))
+                plan.add_project('ravenscar_build.gpr')
             else:
-                projects.append(runtime_build)
+                plan.add_project('runtime_build.gpr')
 
-            # Finally install extra sources and projects if requested by the
+            # Finally extra sources and projects if requested by the
             # target
             extra = self.tgt.other_sources(rts_base_name)
             if extra is not None:
                 for subdir, src_list in extra.items():
-                    dest = os.path.join(rts_path, subdir)
-                    if not os.path.exists(dest):
-                        os.makedirs(dest)
-                    install_files(src_list, dest)
+                    plan.add_directory(subdir)
+                    plan.add_files(src_list, subdir)
             extra_prjs = self.tgt.other_projects(rts_base_name)
             if extra_prjs is not None:
-                projects += [os.path.join(rts_path, prj)
-                             for prj in extra_prjs]
+                for prj in extra_prjs:
+                    plan.add_project(prj)
+
+        self._plans[key] = (runtime_sources, plans)
+        return plans
+
+    def stage(self, destination, rts_descriptor=None, jobs=0):
+        """Installs the target's runtimes in staging directories, next to
+        their final location in destination.
+
+        A previously installed runtime is used as the base of its staging
+        directory, and stays untouched until commit is called.
+
+        Returns the list of projects to build in the staging directories."""
+        destination = os.path.abspath(destination)
+        plans = self.plan(destination, rts_descriptor)
+        projects = []
+
+        # Build target directories
+        if not os.path.exists(destination):
+            os.mkdir(destination)
+
+        for plan in plans:
+            base = None
+            if os.path.exists(plan.rts_path):
+                if not self.overwrite:
+                    print("ERROR: a runtime already exists in")
+                    print("  %s" % plan.rts_path)
+                    print("remove the runtime, use a different installation"
+                          " path or use --force to overwrite")
+                    sys.exit(1)
+                else:
+                    print("WARNING: replacing a previously existing runtime")
+                    print("  %s" % plan.rts_path)
+                    base = plan.rts_path
+
+            staging = os.path.join(
+                os.path.dirname(plan.rts_path),
+                '.%s.staging' % os.path.basename(plan.rts_path))
+            # Leftover of an interrupted installation
+            if os.path.exists(staging):
+                shutil.rmtree(staging)
+
+            execute_plan(plan, jobs=jobs, root=staging, base=base)
+            if base is not None:
+                self._reuse_build_outputs(base, staging)
+            self._staged.append((staging, plan))
+            projects += [os.path.join(staging, prj) for prj in plan.projects]
 
         return projects
+
+    def _reuse_build_outputs(self, base, staging):
+        """Copies the build outputs of the runtime previously installed in
+        base to staging, with their timestamps, so that gprbuild only
+        rebuilds what changed.
+
+        They are not hard linked like the sources: the compiler rewrites
+        its outputs in place, and base must stay intact until the new
+        runtime is committed."""
+        for name in self.build_outputs:
+            old = os.path.join(base, name)
+            if os.path.isfile(old):
+                pairs = [(old, os.path.join(staging, name))]
+            elif os.path.isdir(old):
+                pairs = []
+                for dirpath, _, fnames in os.walk(old):
+                    rel_dir = os.path.relpath(dirpath, base)
+                    for fname in fnames:
+                        pairs.append((os.path.join(dirpath, fname),
+                                      os.path.join(staging, rel_dir, fname)))
+            else:
+                continue
+            for src, dst in pairs:
+                if os.path.islink(src) or os.path.exists(dst):
+                    continue
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                shutil.copy2(src, dst)
+                if FilesHolder.verbose:
+                    print("reuse build output: " + src)
+
+    def stage_variant(self, staging, plan, suffix):
+        """Stages a copy of the runtime staged in staging, whose directory
+        name has the given suffix, to build another variant of it.
+
+        The files are hard linked from the staged runtime. Returns the
+        staging directory and the plan of the copy."""
+        variant = copy.copy(plan)
+        variant.rts_path = '%s-%s' % (plan.rts_path, suffix)
+        variant_staging = os.path.join(
+            os.path.dirname(variant.rts_path),
+            '.%s.staging' % os.path.basename(variant.rts_path))
+        if os.path.exists(variant.rts_path) and not self.overwrite:
+            print("ERROR: a runtime already exists in")
+            print("  %s" % variant.rts_path)
+            print("remove the runtime, use a different installation"
+                  " path or use --force to overwrite")
+            sys.exit(1)
+        if os.path.exists(variant_staging):
+            shutil.rmtree(variant_staging)
+        execute_plan(variant, root=variant_staging, base=staging)
+        if os.path.exists(variant.rts_path):
+            self._reuse_build_outputs(variant.rts_path, variant_staging)
+        self._staged.append((variant_staging, variant))
+        return variant_staging, variant
+
+    def commit(self):
+        """Moves the staged runtimes to their final location.
+
+        Returns the list of projects in their final location."""
+        projects = []
+        for staging, plan in self._staged:
+            swap_in(staging, plan.rts_path)
+            # Record the plan, for future comparisons
+            plan.record()
+            projects += plan.project_paths
+        self._staged = []
+        return projects
+
+    @property
+    def staged(self):
+        """The list of (staging directory, plan) of the runtimes installed
+        by stage and not committed yet"""
+        return list(self._staged)
+
+    def install(self, destination, rts_descriptor=None, jobs=0,
+                dry_run=False):
+        """Installs the target's runtimes in destination.
+
+        With DRY_RUN, only display what would be done, without writing
+        anything on disk.
+
+        Returns the list of projects to build."""
+        if dry_run:
+            projects = []
+            for plan in self.plan(destination, rts_descriptor):
+                report_plan(plan)
+                projects += plan.project_paths
+            return projects
+
+        self.stage(destination, rts_descriptor, jobs)
+        return self.commit()
@@ -0,0 +1,66 @@
+"""Resolved configuration of the runtimes of a board.
+
+query returns, for each runtime of a target, what an installation would
+produce: the scenario variables, the sources with their origin, the linker
+scripts, the loaders and the compiler and linker switches. Nothing is
+written: the result comes from the installation plans (see
+Installer.plan), and relies on the same caches as the installation (the
+resolved sources and the runtime sources descriptors and their index), so
+that tools can call it interactively, e.g. through the build_rts.py server.
+"""
+
+import os
+
+from support.bsp_sources.installer import Installer
+
+
+def _runtime_query(tgt, rts_obj, plan):
+    files = {}
+    for rel, src in sorted(plan.files.items()):
+        rel_dir, fname = os.path.split(rel)
+        files.setdefault(rel_dir, {})[fname] = src
+
+    loaders = {}
+    for loader in tgt.runtime_loaders():
+        if loader != 'USER':
+            loaders[loader] = tgt.loader_switches(loader)
+
+    return {
+        'rts_path': plan.rts_path,
+        'rts_vars': dict(rts_obj.rts_vars),
+        'sources': files,
+        'generated': sorted(plan.generated.keys()),
+        'projects': list(plan.projects),
+        'ld_scripts': [
+            {'name': script.name,
+             'src': script.src,
+             'loaders': list(script.loaders)
+             if script.loaders is not None else None}
+            for script in tgt.ld_scripts],
+        'loaders': loaders,
+        'compiler_switches': list(tgt.compiler_switches),
+        'c_switches': list(tgt.c_switches),
+        'build_flags': dict(
+            (k, list(v)) for k, v in rts_obj.build_flags.items()
+            if v is not None),
+        'ld_switches': [sw['switch'] for sw in tgt.ld_switches
+                        if sw['loader'] is None or sw['loader'] == '']}
+
+
+def query(tgt, destination, rts_descriptor=None, profiles=None):
+    """Returns the resolved configuration of the runtimes of tgt, as a
+    json-serializable dictionary.
+
+    DESTINATION and RTS_DESCRIPTOR are the ones of the installation (see
+    Installer.plan). PROFILES, if set, restricts the result to these
+    runtime profiles."""
+    ret = {'board': tgt.name,
+           'target': tgt.target,
+           'has_small_memory': tgt.has_small_memory,
+           'runtimes': {}}
+    for plan in Installer(tgt).plan(destination, rts_descriptor):
+        if profiles is not None and plan.rts_name not in profiles:
+            continue
+        ret['runtimes'][plan.rts_name] = _runtime_query(
+            tgt, tgt.runtimes[plan.rts_name], plan)
+    return ret
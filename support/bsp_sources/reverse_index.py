@@ -0,0 +1,180 @@
+"""Reverse index of the files used by the runtimes.
+
+Maps each source file (BSP sources, linker scripts, the original sources
+of the shared runtime sources) to the board runtimes using it, so that
+only the runtimes affected by a change need to be rebuilt.
+
+The files of a runtime are the ones of its installation plan. The shared
+runtime sources of the plan are installed copies: they are mapped back
+to the files they come from (in the GNAT sources or in this repository)
+with the origins file written by gen_rts_sources.py along with the
+manifests of the installed sources (see origins_path). Without it, the
+SourceTree is built instead, when the GNAT sources are available.
+Otherwise the origin of the shared sources is unknown, and a change to a
+file that is not otherwise indexed affects all the runtimes using them.
+
+Python files are handled separately: a change to the module of a target
+class (or of its parents) affects the runtimes of that target, and a
+change to the scripts or to the support package (code and data) affects
+all the runtimes.
+"""
+
+import inspect
+import json
+import os
+
+from support import REPO_DIR
+from support.bsp_sources.installer import Installer
+from support.files_holder import FilesHolder
+from support.rts_sources import SourceTree, origins_path
+from support.rts_sources.sources import all_scenarios, sources
+
+
+def _normalize(path):
+    return os.path.realpath(os.path.abspath(path))
+
+
+class ReverseIndex(object):
+    """Index of the runtimes of a set of boards, by file"""
+
+    def __init__(self, destination, rts_descriptor=None):
+        self.destination = destination
+        self.rts_descriptor = rts_descriptor
+        # (board, profile) of each indexed runtime
+        self.runtimes = []
+        # runtimes using each file
+        self.files = {}
+        # runtimes depending on each python module
+        self.modules = {}
+        # installed shared runtime source -> original file, per descriptor
+        self._origins = {}
+        self._trees = {}
+        # runtimes using shared runtime sources of unknown origin
+        self.unresolved = set()
+
+    def _tree(self, is_bb):
+        """The SourceTree of the shared runtime sources, or None if the
+        GNAT sources are not available"""
+        if is_bb not in self._trees:
+            try:
+                self._trees[is_bb] = SourceTree(
+                    is_bb=is_bb, profile='ravenscar-full',
+                    rts_sources=sources, rts_scenarios=all_scenarios)
+            except AssertionError:
+                self._trees[is_bb] = None
+        return self._trees[is_bb]
+
+    def _source_origins(self, rts_sources, is_bb):
+        """Returns the dictionary of the shared runtime sources installed
+        for rts_sources to the files they come from, or None if unknown"""
+        key = (rts_sources.json_file, is_bb)
+        if key not in self._origins:
+            fname = origins_path(rts_sources.json_file)
+            if os.path.isfile(fname):
+                with open(fname, 'r') as fp:
+                    origins = json.load(fp)
+                self._origins[key] = dict(
+                    (_normalize(os.path.join(rts_sources.install_dir, rel)),
+                     _normalize(src))
+                    for rel, src in origins.items())
+            else:
+                self._origins[key] = self._tree_origins(rts_sources, is_bb)
+        return self._origins[key]
+
+    def _tree_origins(self, rts_sources, is_bb):
+        """Same as _source_origins, from the SourceTree"""
+        ret = {}
+        installed = []
+        for lib in rts_sources.libs:
+            installed += [d for d, _ in rts_sources.directories(lib)]
+        if len(installed) == 0:
+            return ret
+        tree = self._tree(is_bb)
+        if tree is None:
+            return None
+        # The installed directories are <root>/<directory of the tree>
+        root = None
+        for d in installed:
+            for name in tree.dirs:
+                if d.endswith(os.sep + name) and \
+                        (root is None or len(d) - len(name) - 1 < len(root)):
+                    root = d[:-len(name) - 1]
+        if root is None:
+            return None
+        for name, pairs in tree.dirs.items():
+            for pair in pairs:
+                ret[_normalize(os.path.join(root, name, pair.dst))] = \
+                    _normalize(pair.src)
+        return ret
+
+    def _add(self, table, key, runtime):
+        table.setdefault(key, set()).add(runtime)
+
+    def add_board(self, board, tgt):
+        """Indexes the runtimes of the target tgt, called board on the
+        command line"""
+        installer = Installer(tgt)
+        plans = installer.plan(self.destination, self.rts_descriptor)
+        origins = self._source_origins(
+            installer.rts_sources, not tgt.is_pikeos)
+        unresolved = origins is None
+        if unresolved:
+            origins = {}
+        for plan in plans:
+            runtime = (board, plan.rts_name)
+            self.runtimes.append(runtime)
+            if unresolved:
+                self.unresolved.add(runtime)
+            for src in plan.files.values():
+                path = _normalize(src)
+                self._add(self.files, path, runtime)
+                if path in origins:
+                    self._add(self.files, origins[path], runtime)
+
+            # The python modules defining the target
+            obj = tgt
+            while obj is not None:
+                for cls in type(obj).__mro__:
+                    try:
+                        fname = inspect.getsourcefile(cls)
+                    except TypeError:
+                        continue
+                    if fname is not None:
+                        self._add(self.modules, _normalize(fname), runtime)
+                obj = getattr(obj, '_parent', None)
+
+    def _candidates(self, path):
+        """The possible locations of a changed file, given relative to the
+        current directory, to this repository or to the GNAT sources"""
+        if os.path.isabs(path):
+            return [_normalize(path)]
+        return [_normalize(os.path.join(d, path))
+                for d in (os.getcwd(), REPO_DIR,
+                          FilesHolder.gnatdir, FilesHolder.gccdir)]
+
+    def affected(self, changed):
+        """Returns the sorted list of (board, profile) runtimes affected by
+        the list of changed files"""
+        repo = _normalize(REPO_DIR)
+        support = os.path.join(repo, 'support') + os.sep
+        ret = set()
+        for path in changed:
+            found = False
+            for cand in self._candidates(path):
+                if cand in self.files:
+                    ret.update(self.files[cand])
+                elif cand in self.modules:
+                    ret.update(self.modules[cand])
+                elif cand.startswith(support) or (
+                        cand.endswith('.py') and
+                        os.path.dirname(cand) == repo):
+                    # generic code and templates of the generated files
+                    ret.update(self.runtimes)
+                else:
+                    continue
+                found = True
+            if not found:
+                # Possibly the origin of a shared runtime source
+                ret.update(self.unresolved)
+        # Keep the order of the indexed runtimes
+        return [rts for rts in self.runtimes if rts in ret]
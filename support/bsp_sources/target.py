@@ -189,6 +189,43 @@ class Target(TargetConfiguration, ArchSupport):
         """List of projects to build in the runtime"""
         return None
 
+    def runtime_loaders(self):
+        """The list of loaders of the runtimes (LOADER scenario variable)"""
+        if self.loaders is not None:
+            # Add USER loader so users can always specify their own linker
+            # script. To ensure the USER loader is always used for this
+            # purpose it cannot be defined by a target
+            assert 'USER' not in self.loaders, \
+                "target cannot define USER loader"
+
+            return list(self.loaders) + ['USER']
+
+        assert len(self.ld_scripts) <= 1, (
+            "target configuration error: no loader specified and several"
+            " ld scripts are defined")
+        if len(self.ld_scripts) == 1:
+            if self.ld_scripts[0].loaders is None or \
+                    'DEFAULT' not in self.ld_scripts[0].loaders:
+                self.ld_scripts[0].add_loader('DEFAULT')
+            return ['DEFAULT', 'USER']
+        return ['USER']
+
+    def loader_switches(self, loader):
+        """The linker switches specific to loader, as a list of groups of
+        arguments (e.g. ['-T', 'script.ld'])"""
+        ret = []
+        for val in self.ld_scripts:
+            if val.loaders is None or loader in val.loaders:
+                ret.append(['-T', val.name])
+        for sw in self.ld_switches:
+            if is_string(sw['loader']) \
+                    and sw['loader'] == loader:
+                ret.append([sw['switch']])
+            if isinstance(sw['loader'], list) \
+                    and loader in sw['loader']:
+                ret.append([sw['switch']])
+        return ret
+
     ###############
     # runtime.xml #
     ###############
@@ -200,24 +237,7 @@ class Target(TargetConfiguration, ArchSupport):
         ret += '<gprconfig>\n'
         ret += '  <configuration>\n'
         ret += '    <config><![CDATA[\n'
-        if self.loaders is not None:
-            # Add USER loader so users can always specify their own linker
-            # script. To ensure the USER loader is always used for this
-            # purpose it cannot be defined by a target
-            assert 'USER' not in self.loaders, \
-                "target cannot define USER loader"
-
-            loaders = list(self.loaders) + ['USER']
-        else:
-            assert len(self.ld_scripts) <= 1, (
-                "target configuration error: no loader specified and several"
-                " ld scripts are defined")
-            if len(self.ld_scripts) == 1:
-                loaders = ['DEFAULT', 'USER']
-                self.ld_scripts[0].add_loader('DEFAULT')
-            else:
-                loaders = ['USER']
-
+        loaders = self.runtime_loaders()
         ret += '   type Loaders is ("%s");\n' % '", "'.join(
             loaders)
         ret += '   Loader : Loaders := external("LOADER", "%s");\n\n' % \
@@ -299,17 +319,8 @@ class Target(TargetConfiguration, ArchSupport):
                 indent += 3
                 blank = indent * ' '
 
-                switches = []
-                for val in self.ld_scripts:
-                    if val.loaders is None or loader in val.loaders:
-                        switches.append('"-T", "%s"' % val.name)
-                for sw in self.ld_switches:
-                    if is_string(sw['loader']) \
-                            and sw['loader'] == loader:
-                        switches.append('"%s"' % sw['switch'])
-                    if isinstance(sw['loader'], list) \
-                            and loader in sw['loader']:
-                        switches.append('"%s"' % sw['switch'])
+                switches = [', '.join('"%s"' % arg for arg in group)
+                            for group in self.loader_switches(loader)]
                 if len(switches) > 0:
                     ret += blank
                     ret += \
@@ -0,0 +1,128 @@
+"""Compilation times of the runtime units.
+
+When build_rts.py is called with --compile-times, the compiler wrapper
+(rts_cc.py) times each compilation and appends a record to a log file: one
+json object per line, with the compiled source, the runtime, the duration
+and whether the objects came from the object cache. At the end of the
+build, the log is merged into a database of the compilation times, that
+accumulates the runs, and a ranking of the most expensive units and
+runtimes is printed.
+
+The database is a json file:
+  {"runs": <number of runs merged>,
+   "units": {<source>: <stats>},
+   "runtimes": {<runtime>: <stats>}}
+where stats is {"compilations", "cached", "total", "max"}, durations being
+in seconds. Cached compilations are counted, but not timed.
+"""
+
+import json
+import os
+
+from support import write_if_changed
+
+
+def record(log_file, source, runtime, seconds, cached=False):
+    """Appends the record of a compilation to log_file"""
+    line = json.dumps({'source': source, 'runtime': runtime,
+                       'time': round(seconds, 4), 'cached': cached})
+    # A single write in append mode, so that the records of concurrent
+    # compilations are not mixed
+    fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (line + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def read_log(log_file):
+    """Returns the records of log_file"""
+    ret = []
+    if not os.path.isfile(log_file):
+        return ret
+    with open(log_file, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                ret.append(json.loads(line))
+            except ValueError:
+                # interrupted compilation
+                continue
+    return ret
+
+
+def _new_stats():
+    return {'compilations': 0, 'cached': 0, 'total': 0.0, 'max': 0.0}
+
+
+def _merge_stats(dst, src):
+    dst['compilations'] += src['compilations']
+    dst['cached'] += src['cached']
+    dst['total'] = round(dst['total'] + src['total'], 4)
+    dst['max'] = max(dst['max'], src['max'])
+
+
+class CompileTimes(object):
+    """Database of the compilation times"""
+
+    def __init__(self):
+        self.runs = 0
+        self.units = {}
+        self.runtimes = {}
+
+    @staticmethod
+    def load(filename):
+        ret = CompileTimes()
+        if os.path.isfile(filename):
+            with open(filename, 'r') as fp:
+                cnt = json.load(fp)
+            ret.runs = cnt.get('runs', 0)
+            ret.units = cnt.get('units', {})
+            ret.runtimes = cnt.get('runtimes', {})
+        return ret
+
+    def save(self, filename):
+        write_if_changed(filename, json.dumps(
+            {'runs': self.runs, 'units': self.units,
+             'runtimes': self.runtimes}, indent=1, sort_keys=True))
+
+    def add_records(self, records):
+        """Adds the records of a run"""
+        self.runs += 1
+        for rec in records:
+            stats = _new_stats()
+            stats['compilations'] = 1
+            if rec.get('cached'):
+                stats['cached'] = 1
+            else:
+                stats['total'] = rec['time']
+                stats['max'] = rec['time']
+            for table, key in ((self.units, rec['source']),
+                               (self.runtimes, rec['runtime'])):
+                _merge_stats(table.setdefault(key, _new_stats()), stats)
+
+    def merge(self, other):
+        """Adds the runs of another database"""
+        self.runs += other.runs
+        for table, other_table in ((self.units, other.units),
+                                   (self.runtimes, other.runtimes)):
+            for key, stats in other_table.items():
+                _merge_stats(table.setdefault(key, _new_stats()), stats)
+
+    def ranking(self, table, count=20):
+        """Returns the lines of the table of the count most expensive entries
+        of table (self.units or self.runtimes)"""
+        entries = sorted(table.items(),
+                         key=lambda item: (-item[1]['total'], item[0]))
+        width = max([len(key) for key, _ in entries[:count]] + [4])
+        ret = ['%-*s %10s %8s %8s %6s' % (
+            width, 'name', 'total (s)', 'mean', 'max', 'count')]
+        for key, stats in entries[:count]:
+            timed = stats['compilations'] - stats['cached']
+            mean = stats['total'] / timed if timed > 0 else 0.0
+            ret.append('%-*s %10.2f %8.3f %8.3f %6d' % (
+                width, key, stats['total'], mean, stats['max'],
+                stats['compilations']))
+        return ret
@@ -1,12 +1,27 @@
-import shutil
 import os
 import os.path
 
 from support.files_holder import FilesHolder
-from support import fullpath
+from support import fullpath, readfile, write_if_changed
+
+
+def _copy_if_changed(src, dest):
+    """Copies src to dest, unless dest already has the same content.
+
+    This keeps the timestamps of the unchanged files, so that the sphinx
+    build of the documentation remains incremental."""
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    return write_if_changed(dest, readfile(src))
 
 
 def docgen(boards, target, dest):
+    """Generates the runtimes documentation in dest.
+
+    Only the metadata of the boards is used here (name, readme_file and
+    the list of runtimes), so the boards may be created with
+    FilesHolder.resolve_sources unset. Files whose content is unchanged are
+    not rewritten."""
     if not os.path.exists(dest):
         os.makedirs(dest)
 
@@ -18,17 +33,13 @@ def docgen(boards, target, dest):
     src = os.path.join(PWD, 'data', 'doc')
     for base in ('Makefile', 'reconfigurablerts.rst'):
         srcfile = os.path.join(src, base)
-        shutil.copy(srcfile, dest)
-    conf = os.path.join(src, 'conf.py')
-    with open(conf, 'r') as fp:
-        cnt = fp.read()
+        _copy_if_changed(srcfile, dest)
+    cnt = readfile(os.path.join(src, 'conf.py'))
     cnt = cnt.replace('@target@', target)
-    conf = os.path.join(dest, 'conf.py')
-    with open(conf, 'w') as fp:
-        fp.write(cnt)
+    write_if_changed(os.path.join(dest, 'conf.py'), cnt)
     gnatvsn = os.path.join(gnatdir, 'gnatvsn.ads')
     if os.path.exists(gnatvsn):
-        shutil.copy(gnatvsn, dest)
+        _copy_if_changed(gnatvsn, dest)
 
     readmes = {}
     files = {}
@@ -41,56 +52,57 @@ def docgen(boards, target, dest):
         if board.name not in runtimes:
             runtimes[board.name] = board.runtimes
 
-    overall_readme = os.path.join(dest, "index.rst")
-    with open(overall_readme, "w") as fp:
-        title = "GNAT for %s run-times documentation" % target
-        fp.write("%s\n" % ("=" * len(title)))
-        fp.write("%s\n" % title)
-        fp.write("%s\n\n" % ("=" * len(title)))
-        fp.write(".. only:: not latex\n\n")
-        fp.write("   .. only:: PRO\n\n")
-        fp.write("      *GNAT Pro Edition*\n\n")
-        fp.write("   .. only:: GPL\n\n")
-        fp.write("      *GNAT GPL Edition*\n\n")
-        fp.write("   | Version |version|\n")
-        fp.write("   | Date: |today|\n\n")
-        fp.write("   .. contents:: Table of Contents\n")
-        fp.write("      :depth: 2\n\n")
-
-        # List of runtimes:
-
-        if target is not None:
-            title = "Run-times available with the %s compiler" % target
-        else:
-            title = "Run-times available in this package"
-        fp.write("%s\n" % title)
-        fp.write("%s\n\n" % ("=" * len(title)))
-        if target is not None:
-            fp.write(("The %s compiler comes with"
+    lines = []
+    title = "GNAT for %s run-times documentation" % target
+    lines.append("%s\n" % ("=" * len(title)))
+    lines.append("%s\n" % title)
+    lines.append("%s\n\n" % ("=" * len(title)))
+    lines.append(".. only:: not latex\n\n")
+    lines.append("   .. only:: PRO\n\n")
+    lines.append("      *GNAT Pro Edition*\n\n")
+    lines.append("   .. only:: GPL\n\n")
+    lines.append("      *GNAT GPL Edition*\n\n")
+    lines.append("   | Version |version|\n")
+    lines.append("   | Date: |today|\n\n")
+    lines.append("   .. contents:: Table of Contents\n")
+    lines.append("      :depth: 2\n\n")
+
+    # List of runtimes:
+
+    if target is not None:
+        title = "Run-times available with the %s compiler" % target
+    else:
+        title = "Run-times available in this package"
+    lines.append("%s\n" % title)
+    lines.append("%s\n\n" % ("=" * len(title)))
+    if target is not None:
+        lines.append(("The %s compiler comes with"
                       " the following run-times:\n\n") % target)
-        else:
-            fp.write(("This package adds support for"
+    else:
+        lines.append(("This package adds support for"
                       " the following run-times:\n\n"))
-        for board in sorted(runtimes.keys()):
-            fp.write("* %s" % board)
-            if board in readmes.keys():
-                ref = files[readmes[board]]
-                fp.write(" (see :ref:`%s`)" % ref)
-            fp.write("\n\n")
-            for rts in sorted(runtimes[board]):
-                fp.write('  - %s\n' % rts)
-            fp.write("\n\n")
-
-        # General description of runtime location, usage, and rebuild procedure
-
-        fp.write(".. include:: reconfigurablerts.rst\n\n")
-
-        # Detailed description of the BSP
-
-        for f in sorted(files):
-            fname = "bsp-%s.rst" % files[f]
-            fp.write(".. _%s:\n" % files[f])
-            fp.write(".. include:: %s\n\n" % fname)
-            shutil.copy(fullpath(f), os.path.join(dest, "%s" % fname))
-        fp.write("\n")
-        print("documentation successfully generated in %s" % dest)
+    for board in sorted(runtimes.keys()):
+        lines.append("* %s" % board)
+        if board in readmes.keys():
+            ref = files[readmes[board]]
+            lines.append(" (see :ref:`%s`)" % ref)
+        lines.append("\n\n")
+        for rts in sorted(runtimes[board]):
+            lines.append('  - %s\n' % rts)
+        lines.append("\n\n")
+
+    # General description of runtime location, usage, and rebuild procedure
+
+    lines.append(".. include:: reconfigurablerts.rst\n\n")
+
+    # Detailed description of the BSP
+
+    for f in sorted(files):
+        fname = "bsp-%s.rst" % files[f]
+        lines.append(".. _%s:\n" % files[f])
+        lines.append(".. include:: %s\n\n" % fname)
+        _copy_if_changed(fullpath(f), os.path.join(dest, "%s" % fname))
+    lines.append("\n")
+
+    write_if_changed(os.path.join(dest, "index.rst"), ''.join(lines))
+    print("documentation successfully generated in %s" % dest)
@@ -1,8 +1,98 @@
+import hashlib
+import json
 import os
 import shutil
 import sys
+import threading
 
-from support import fullpath, is_string
+from support import fullpath, is_string, write_if_changed
+
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request cloning a whole file (reflink) on Linux filesystems that
+# support it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# Pairs of devices (src, dst) on which reflinks are known not to work
+_no_reflink = set()
+
+# Size of the chunks used to compare or copy files
+CHUNK_SIZE = 1024 * 1024
+
+
+def same_content(path1, path2):
+    "Whether path1 and path2 have the same content"
+    if os.path.getsize(path1) != os.path.getsize(path2):
+        return False
+    with open(path1, 'rb') as fp1:
+        with open(path2, 'rb') as fp2:
+            while True:
+                b1 = fp1.read(CHUNK_SIZE)
+                b2 = fp2.read(CHUNK_SIZE)
+                if b1 != b2:
+                    return False
+                if not b1:
+                    return True
+
+
+def _copy_data(fsrc, fdst, size):
+    """Copy the content of the file object fsrc into fdst, letting the
+    kernel do the job when possible"""
+    src_fd = fsrc.fileno()
+    dst_fd = fdst.fileno()
+    devs = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+
+    # Reflink: the new file shares the data blocks of the source
+    if fcntl is not None and devs not in _no_reflink:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except (IOError, OSError):
+            _no_reflink.add(devs)
+
+    # In-kernel copy
+    copied = 0
+    for fun in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, fun):
+            continue
+        try:
+            while copied < size:
+                if fun == 'copy_file_range':
+                    n = os.copy_file_range(src_fd, dst_fd, size - copied)
+                else:
+                    n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            if copied >= size:
+                return
+        except OSError:
+            pass
+        if copied > 0:
+            # partial copy: restart from the current offset
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            break
+
+    # Fallback: copy through user space
+    shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+
+def _copy_file(src, dst):
+    """Copy src to dst, with the permission bits of src.
+
+    The mode is set when creating dst, so that no extra syscall is needed
+    (it is subject to the umask, as with cp)."""
+    st = os.stat(src)
+    with open(src, 'rb') as fsrc:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     st.st_mode & 0o777)
+        with os.fdopen(fd, 'wb') as fdst:
+            _copy_data(fsrc, fdst, st.st_size)
 
 
 def _copy(src, dst):
@@ -15,11 +105,7 @@ def _copy(src, dst):
     already_exists = False
 
     if os.path.isfile(dst):
-        with open(dst, 'r') as fp:
-            cnt1 = fp.read()
-        with open(src, 'r') as fp:
-            cnt2 = fp.read()
-        if cnt1 != cnt2:
+        if not same_content(src, dst):
             print("runtime file " + dst + " already exists")
             print("cannot install " + src)
             sys.exit(5)
@@ -35,37 +121,200 @@ def _copy(src, dst):
         if FilesHolder.link:
             os.symlink(os.path.abspath(src), dst)
         else:
-            shutil.copy(src, dst)
+            _copy_file(src, dst)
+
+
+def _file_stat(path):
+    "Returns the (size, mtime) signature of path, or None"
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def file_hash(path):
+    "Returns the sha1 of the content of path"
+    h = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class InstallManifest(object):
+    """Records the stat signature and hash of the files installed in a tree.
+
+    This is unrelated to MANIFEST.GNAT: it allows a subsequent installation
+    in the same place to skip the files that did not change since the
+    previous run, without reading them. As it holds paths and stat data of
+    the build host, it is not stored in the installed tree but in
+    state_dir, under a name derived from the installation directory.
+    """
+    # Name of the manifest in the installed tree, in previous versions
+    filename = '.rts-manifest.json'
+
+    state_dir = os.path.join(
+        os.environ.get('XDG_CACHE_HOME',
+                       os.path.join(os.path.expanduser('~'), '.cache')),
+        'bb-runtimes', 'manifests')
+
+    def __init__(self, root):
+        self.root = root
+        key = hashlib.sha1(
+            os.path.realpath(root).encode('utf-8')).hexdigest()
+        self.path = os.path.join(self.state_dir, key + '.json')
+        # Do not ship the manifest of previous versions
+        legacy = os.path.join(root, self.filename)
+        if os.path.isfile(legacy):
+            os.unlink(legacy)
+        self._lock = threading.Lock()
+        self._previous = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as fp:
+                    self._previous = json.load(fp)
+            except ValueError:
+                # corrupted manifest: just ignore it
+                self._previous = {}
+        self._entries = dict(self._previous)
+        # Source installed to each destination during this run
+        self._installed = {}
+
+    def install(self, src, dst):
+        "Install src as dst, rewriting dst only if src changed"
+        rel = os.path.relpath(dst, self.root)
+        with self._lock:
+            done = self._installed.setdefault(rel, src)
+        if done != src:
+            # Another source was already installed to dst during this run:
+            # the regular checks report the conflict
+            _copy(src, dst)
+            return
+        prev = self._previous.get(rel)
+        src_stat = _file_stat(src)
+        dst_stat = _file_stat(dst)
+
+        if prev is not None and dst_stat is not None \
+                and prev['dst_stat'] == dst_stat:
+            # dst is still the file we installed last time
+            if prev['src'] == src and prev['src_stat'] == src_stat:
+                if FilesHolder.verbose:
+                    print("unchanged, skip: " + src + ", " + dst)
+                return
+            sha1 = file_hash(src)
+            if sha1 != prev['sha1']:
+                if FilesHolder.verbose:
+                    print("update " + dst + " from " + src)
+                os.unlink(dst)
+                _copy(src, dst)
+                dst_stat = _file_stat(dst)
+        else:
+            # unknown or modified dst: use the regular checks
+            _copy(src, dst)
+            dst_stat = _file_stat(dst)
+            sha1 = file_hash(src)
+
+        with self._lock:
+            self._entries[rel] = {
+                'src': src, 'src_stat': src_stat,
+                'dst_stat': dst_stat, 'sha1': sha1}
+
+    def save(self):
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir, exist_ok=True)
+        write_if_changed(
+            self.path, json.dumps(self._entries, indent=1, sort_keys=True))
+
+
+def copy_files(copies, jobs=0, manifest=None):
+    """Copy a list of (src, dst) tuples using a pool of threads.
+
+    JOBS is the number of threads to use, 0 meaning the number of CPUs.
+    If MANIFEST is set, then it is used to skip the files that are already
+    up-to-date."""
+    if manifest is None or FilesHolder.link:
+        install = _copy
+    else:
+        install = manifest.install
+
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    # Copies to the same destination are done sequentially, in order, so
+    # that conflicting sources are still reported.
+    tasks = []
+    by_dst = {}
+    for src, dst in copies:
+        if dst not in by_dst:
+            by_dst[dst] = []
+            tasks.append(by_dst[dst])
+        by_dst[dst].append((src, dst))
+
+    def run(task):
+        for src, dst in task:
+            install(src, dst)
+
+    if jobs == 1 or len(tasks) < 2:
+        for task in tasks:
+            run(task)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
 
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            # Consume the results to propagate errors
+            for _ in pool.map(run, tasks):
+                pass
 
-class FilePair(object):
-    def __init__(self, dst, src):
-        self._dst = dst
+    if manifest is not None:
+        manifest.save()
 
-        # Full path to the source file
-        self._src = None
 
-        if '/' not in src:
-            # Files without path elements are in gnat
-            assert FilesHolder.manifest, "Error: MANIFEST file not found"
-            assert src in FilesHolder.manifest, \
-                "Error: source file %s not in MANIFEST" % src
-            self._src = os.path.join(FilesHolder.gnatdir, src)
+def _resolve_source(src):
+    """Returns the full path of the source file src.
 
-        elif src.split('/')[0] in ('hie', 'libgnarl', 'libgnat'):
-            # BB-specific file in gnat/hie
-            self._src = os.path.join(FilesHolder.gnatdir, src)
-            assert os.path.exists(self._src), \
-                "Error: source file %s not found in gnat" % src
+    The result is cached, so that several source trees or targets created
+    in the same process only look each file up once."""
+    key = (FilesHolder.gnatdir, FilesHolder.gccdir, src)
+    if key in FilesHolder.resolved_sources:
+        return FilesHolder.resolved_sources[key]
 
-        else:
-            # Look into the current repository
-            self._src = fullpath(src)
+    if '/' not in src:
+        # Files without path elements are in gnat
+        assert FilesHolder.manifest, "Error: MANIFEST file not found"
+        assert src in FilesHolder.manifest, \
+            "Error: source file %s not in MANIFEST" % src
+        ret = os.path.join(FilesHolder.gnatdir, src)
 
-            if not os.path.exists(self._src):
-                # Look into gcc
-                self._src = os.path.join(FilesHolder.gccdir, src)
-        assert os.path.exists(self._src)
+    elif src.split('/')[0] in ('hie', 'libgnarl', 'libgnat'):
+        # BB-specific file in gnat/hie
+        ret = os.path.join(FilesHolder.gnatdir, src)
+        assert os.path.exists(ret), \
+            "Error: source file %s not found in gnat" % src
+
+    else:
+        # Look into the current repository
+        ret = fullpath(src)
+
+        if not os.path.exists(ret):
+            # Look into gcc
+            ret = os.path.join(FilesHolder.gccdir, src)
+    assert os.path.exists(ret)
+
+    FilesHolder.resolved_sources[key] = ret
+    return ret
+
+
+class FilePair(object):
+    def __init__(self, dst, src):
+        self._dst = dst
+
+        # Full path to the source file. The lookup is skipped when only the
+        # metadata of the targets is needed (see FilesHolder.resolve_sources)
+        if FilesHolder.resolve_sources:
+            self._src = _resolve_source(src)
+        else:
+            self._src = src
 
     def __eq__(self, other):
         if is_string(other):
@@ -78,6 +327,14 @@ class FilePair(object):
     def __str__(self):
         return self._dst
 
+    @property
+    def src(self):
+        return self._src
+
+    @property
+    def dst(self):
+        return self._dst
+
     def install(self, dir):
         _copy(self._src, os.path.join(dir, self._dst))
 
@@ -90,6 +347,14 @@ class FilesHolder(object):
     # Gnat MANIFEST file
     manifest = None
 
+    # Cache of the full path of the source files, see _resolve_source
+    resolved_sources = {}
+
+    # Whether to look for the source files when they are added. This can be
+    # disabled when only the targets metadata is needed, in which case the
+    # gnat and gcc sources do not need to be available.
+    resolve_sources = True
+
     # Display actions
     verbose = False
 
@@ -112,16 +377,18 @@ class FilesHolder(object):
     def __init__(self):
         self.dirs = {}
 
-        # Read manifest file (if exists)
+        # Read manifest file (if exists). It is only published once
+        # complete, for the objects created concurrently.
         if FilesHolder.manifest is None:
             manifest_file = os.path.join(self.gnatdir, "MANIFEST.GNAT")
-            FilesHolder.manifest = []
+            manifest = set()
             if os.path.isfile(manifest_file):
                 f = open(manifest_file, 'r')
                 for line in f:
                     line = line.strip()
                     if line and not line.startswith('--'):
-                        FilesHolder.manifest.append(line)
+                        manifest.add(line)
+            FilesHolder.manifest = manifest
 
     def add_source_alias(self, dir, dst, src):
         """Add source.
@@ -0,0 +1,247 @@
+"""Code and data footprint of the built runtimes.
+
+Reads the objects of the runtime libraries (adalib/lib*.a) and attributes
+the size of their .text, .rodata, .data and .bss sections to the runtime
+sources directory the unit comes from, and to the scenario variables that
+select this directory (see rts-sources.json). This is what the choice of
+the runtime profile and of the Add_* scenario variables of a board costs
+in flash and RAM.
+
+The archives and ELF objects are read directly, so that no binutils is
+needed for the target.
+"""
+
+import csv
+import json
+import os
+import struct
+
+# Section categories reported
+CATEGORIES = ('text', 'rodata', 'data', 'bss', 'other')
+
+# Extensions of the units sources, by order of preference to find the
+# origin of an object
+_SOURCE_EXT = ('.adb', '.c', '.S', '.s', '.ads')
+
+# ELF constants
+_SHT_NOBITS = 8
+_SHT_SYMTAB = 2
+_SHF_ALLOC = 0x2
+_SHN_COMMON = 0xfff2
+
+
+class FormatError(Exception):
+    pass
+
+
+def read_archive(path):
+    """Returns the list of (name, data) members of the ar archive path"""
+    with open(path, 'rb') as fp:
+        cnt = fp.read()
+    if not cnt.startswith(b'!<arch>\n'):
+        raise FormatError('%s: not an archive' % path)
+    ret = []
+    long_names = b''
+    pos = 8
+    while pos + 60 <= len(cnt):
+        header = cnt[pos:pos + 60]
+        if header[58:60] != b'`\n':
+            raise FormatError('%s: invalid member header' % path)
+        name = header[0:16].decode('latin-1').rstrip()
+        size = int(header[48:58].decode('latin-1').strip())
+        data = cnt[pos + 60:pos + 60 + size]
+        # members are aligned on 2 bytes
+        pos += 60 + size + (size & 1)
+
+        if name == '//':
+            # GNU long names table
+            long_names = data
+            continue
+        elif name in ('/', '/SYM64/', '__.SYMDEF', '__.SYMDEF SORTED'):
+            # symbol table
+            continue
+        elif name.startswith('#1/'):
+            # BSD long name, stored at the start of the data
+            length = int(name[3:])
+            name = data[:length].decode('latin-1').rstrip('\0')
+            data = data[length:]
+        elif name.startswith('/') and name[1:].isdigit():
+            offset = int(name[1:])
+            end = long_names.find(b'/\n', offset)
+            name = long_names[offset:end].decode('latin-1')
+        elif name.endswith('/'):
+            name = name[:-1]
+        ret.append((name, data))
+    return ret
+
+
+def _category(name, sh_type):
+    if sh_type == _SHT_NOBITS or name.startswith(('.bss', '.sbss', '.tbss')):
+        return 'bss'
+    elif name.startswith('.text'):
+        return 'text'
+    elif name.startswith(('.rodata', '.srodata')):
+        return 'rodata'
+    elif name.startswith(('.data', '.sdata', '.tdata')):
+        return 'data'
+    return 'other'
+
+
+def elf_sizes(data):
+    """Returns the size of each section category of the ELF object data,
+    as a dictionary. Only the sections allocated in memory are taken into
+    account, and common symbols are counted as .bss."""
+    if data[:4] != b'\x7fELF':
+        raise FormatError('not an ELF object')
+    is64 = data[4] == 2
+    endian = '<' if data[5] == 1 else '>'
+    if is64:
+        ehdr = struct.unpack_from(endian + 'HHIQQQIHHHHHH', data, 16)
+        shdr_fmt = endian + 'IIQQQQIIQQ'
+        sym_fmt = endian + 'IBBHQQ'
+    else:
+        ehdr = struct.unpack_from(endian + 'HHIIIIIHHHHHH', data, 16)
+        shdr_fmt = endian + 'IIIIIIIIII'
+        sym_fmt = endian + 'IIIBBH'
+    shoff, shentsize, shnum, shstrndx = ehdr[5], ehdr[10], ehdr[11], ehdr[12]
+
+    sections = [struct.unpack_from(shdr_fmt, data, shoff + i * shentsize)
+                for i in range(shnum)]
+    strtab_off = sections[shstrndx][4] if shstrndx < shnum else 0
+
+    def section_name(offset):
+        end = data.find(b'\0', strtab_off + offset)
+        return data[strtab_off + offset:end].decode('latin-1')
+
+    ret = dict((cat, 0) for cat in CATEGORIES)
+    for sh_name, sh_type, sh_flags, _, sh_offset, sh_size, _, _, _, _ \
+            in sections:
+        if sh_type == _SHT_SYMTAB:
+            # Common symbols are allocated in .bss by the linker
+            sym_size = struct.calcsize(sym_fmt)
+            for off in range(sh_offset + sym_size, sh_offset + sh_size,
+                             sym_size):
+                sym = struct.unpack_from(sym_fmt, data, off)
+                if is64:
+                    shndx, size = sym[3], sym[5]
+                else:
+                    shndx, size = sym[5], sym[2]
+                if shndx == _SHN_COMMON:
+                    ret['bss'] += size
+        if not sh_flags & _SHF_ALLOC:
+            continue
+        ret[_category(section_name(sh_name), sh_type)] += sh_size
+    return ret
+
+
+def source_directories(rts_sources, libs=('gnat', 'gnarl')):
+    """Returns a dictionary of the runtime sources directories described
+    by rts_sources (a SharedRTSSources) to the list of scenario conditions
+    (var:value) selecting them"""
+    ret = {}
+    for lib in libs:
+        if lib in rts_sources.libs:
+            for d, conditions in rts_sources.directories(lib):
+                ret[d] = conditions
+    return ret
+
+
+def _origins(plan, rts_sources):
+    """Returns a dictionary of the unit names of the runtime of plan to
+    their origin: (directory, conditions)"""
+    dirs = {}
+    root = None
+    if rts_sources is not None:
+        dirs = source_directories(rts_sources)
+        if len(dirs) > 0:
+            root = os.path.commonpath(list(dirs.keys()))
+            if len(dirs) == 1:
+                root = os.path.dirname(root)
+
+    candidates = {}
+    for rel, src in plan.files.items():
+        unit, ext = os.path.splitext(os.path.basename(rel))
+        if ext not in _SOURCE_EXT:
+            continue
+        src_dir = os.path.dirname(os.path.abspath(src))
+        if src_dir in dirs:
+            origin = (os.path.relpath(src_dir, root), dirs[src_dir])
+        else:
+            # Sources of the board support
+            origin = ('bsp:%s' % os.path.dirname(rel), [])
+        candidates.setdefault(unit, []).append(
+            (_SOURCE_EXT.index(ext), origin))
+    for rel in plan.generated:
+        unit, ext = os.path.splitext(os.path.basename(rel))
+        if ext in _SOURCE_EXT:
+            candidates.setdefault(unit, []).append(
+                (_SOURCE_EXT.index(ext), ('generated', [])))
+    return dict((unit, sorted(lst, key=lambda c: c[0])[0][1])
+                for unit, lst in candidates.items())
+
+
+def footprint(rts_dir, plan, rts_sources=None):
+    """Computes the footprint of the runtime built in rts_dir, installed
+    with plan from rts_sources.
+
+    Returns the report as a json-serializable dictionary."""
+    origins = _origins(plan, rts_sources)
+    adalib = os.path.join(rts_dir, 'adalib')
+    totals = dict((cat, 0) for cat in CATEGORIES)
+    by_dir = {}
+    by_scenario = {}
+    libraries = {}
+    for lib in sorted(os.listdir(adalib)) if os.path.isdir(adalib) else []:
+        if not lib.endswith('.a'):
+            continue
+        lib_totals = dict((cat, 0) for cat in CATEGORIES)
+        libraries[lib] = lib_totals
+        for name, data in read_archive(os.path.join(adalib, lib)):
+            try:
+                sizes = elf_sizes(data)
+            except (FormatError, struct.error, IndexError):
+                # Not an ELF object (e.g. COFF objects on Windows)
+                continue
+            unit, _ = os.path.splitext(name)
+            directory, conditions = origins.get(unit, ('unknown', []))
+            entry = by_dir.setdefault(directory, {
+                'directory': directory,
+                'conditions': conditions,
+                'units': []})
+            entry['units'].append(name)
+            # The directory is accounted to its innermost condition, i.e. the
+            # scenario variable that adds it
+            scenario = conditions[-1] if len(conditions) > 0 else 'common'
+            scn = by_scenario.setdefault(
+                scenario, dict((cat, 0) for cat in CATEGORIES))
+            for cat in CATEGORIES:
+                entry[cat] = entry.get(cat, 0) + sizes[cat]
+                scn[cat] += sizes[cat]
+                lib_totals[cat] += sizes[cat]
+                totals[cat] += sizes[cat]
+
+    directories = sorted(
+        by_dir.values(),
+        key=lambda e: (-sum(e[cat] for cat in CATEGORIES), e['directory']))
+    for entry in directories:
+        entry['units'].sort()
+    return {'runtime': os.path.basename(plan.rts_path),
+            'totals': totals,
+            'libraries': libraries,
+            'directories': directories,
+            'scenarios': by_scenario}
+
+
+def write_report(report, json_file, csv_file=None):
+    with open(json_file, 'w') as fp:
+        fp.write(json.dumps(report, indent=1, sort_keys=True))
+        fp.write('\n')
+    if csv_file is None:
+        return
+    with open(csv_file, 'w') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(('directory', 'conditions') + CATEGORIES)
+        for entry in report['directories']:
+            writer.writerow(
+                (entry['directory'], ' '.join(entry['conditions'])) +
+                tuple(entry[cat] for cat in CATEGORIES))
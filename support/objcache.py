@@ -0,0 +1,431 @@
+"""Content-addressed cache of the objects compiled for the runtimes.
+
+The runtimes of many boards share most of their units, compiled with the
+same switches for the same target. The compiler wrapper (rts_cc.py) uses
+this cache to reuse the outputs of such compilations.
+
+The cache is organized as follows:
+  <root>/<key[:2]>/<key>/entries.json
+  <root>/<key[:2]>/<key>/<entry>/<outputs>
+
+The key is computed from the compiler identification, the normalized
+command line and the content of the compiled source. As Ada (and C) units
+also depend on other sources (specs, system.ads, headers), each key may
+have several entries, each one recording the content of the dependencies
+of the compilation. An entry is reused only if all those dependencies
+are unchanged.
+
+Paths below the runtime being built are stored relative to a placeholder
+so that the outputs can be shared between boards.
+"""
+
+import calendar
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Placeholder for the runtime directory in the cached files
+ROOT_PLACEHOLDER = '@RTS_ROOT@'
+
+# Suffixes of the compiled sources
+SOURCE_EXT = ('.adb', '.ads', '.ada', '.c', '.s', '.S')
+
+# Switches whose value does not influence the compilation outputs, or is
+# taken into account separately
+IGNORED_SWITCHES = ('-gnatem=', '-fdebug-prefix-map=')
+
+# Preprocessor switches generating a dependency file
+DEP_SWITCHES = ('-MD', '-MMD')
+
+# Runtime subdirectories where Ada dependencies are looked for when no
+# mapping file is available
+ADA_SOURCE_DIRS = ('gnat_user', 'gnat', 'gnarl_user', 'gnarl')
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class Compilation(object):
+    """A compiler command line, and what can be deduced from it"""
+
+    def __init__(self, args, root, cwd=None):
+        self.args = list(args)
+        self.root = os.path.abspath(root)
+        self.cwd = cwd if cwd is not None else os.getcwd()
+        self.source = None
+        self.obj = None
+        self.dep_file = None
+        self.mapping_file = None
+        self.target_properties = None
+        # Whether a dependency file is generated
+        gen_deps = False
+
+        i = 0
+        while i < len(self.args):
+            arg = self.args[i]
+            if arg == '-o' and i + 1 < len(self.args):
+                self.obj = self._abs(self.args[i + 1])
+                i += 1
+            elif arg == '-MF' and i + 1 < len(self.args):
+                self.dep_file = self._abs(self.args[i + 1])
+                i += 1
+            elif arg.startswith('-MF'):
+                self.dep_file = self._abs(arg[len('-MF'):])
+            elif arg in DEP_SWITCHES:
+                gen_deps = True
+            elif arg.startswith('-Wp,'):
+                # Preprocessor options, e.g. -Wp,-MD,<file>
+                opts = arg.split(',')[1:]
+                for j, opt in enumerate(opts):
+                    if opt in DEP_SWITCHES + ('-MF', ) and \
+                            j + 1 < len(opts):
+                        self.dep_file = self._abs(opts[j + 1])
+                    elif opt in DEP_SWITCHES:
+                        gen_deps = True
+            elif arg.startswith('-gnatem='):
+                self.mapping_file = self._abs(arg[len('-gnatem='):])
+            elif arg.startswith('-gnatet='):
+                self.target_properties = self._abs(arg[len('-gnatet='):])
+            elif not arg.startswith('-') and arg.endswith(SOURCE_EXT):
+                self.source = self._abs(arg)
+            i += 1
+
+        if self.source is not None and self.obj is None:
+            base, _ = os.path.splitext(os.path.basename(self.source))
+            self.obj = os.path.join(self.cwd, base + '.o')
+        if gen_deps and self.dep_file is None and self.obj is not None:
+            # The default dependency file, next to the object
+            base, _ = os.path.splitext(self.obj)
+            self.dep_file = base + '.d'
+
+    def _abs(self, path):
+        return os.path.normpath(os.path.join(self.cwd, path))
+
+    @property
+    def cacheable(self):
+        """Whether the outputs of the compilation can be cached. This needs
+        its dependencies: the ALI file of the Ada units, or a dependency file
+        for the preprocessed ones (C, assembly with cpp)"""
+        if '-c' not in self.args or self.source is None:
+            return False
+        if self.is_ada or self.source.endswith('.s'):
+            return True
+        return self.dep_file is not None
+
+    @property
+    def is_ada(self):
+        return self.source.endswith(('.adb', '.ads', '.ada'))
+
+    @property
+    def ali(self):
+        if not self.is_ada:
+            return None
+        base, _ = os.path.splitext(self.obj)
+        return base + '.ali'
+
+    @property
+    def callgraph_info(self):
+        """The call graph file produced with -fcallgraph-info"""
+        if not any(arg.startswith('-fcallgraph-info') for arg in self.args):
+            return None
+        base, _ = os.path.splitext(self.obj)
+        return base + '.ci'
+
+    @property
+    def outputs(self):
+        """The list of files produced by the compilation"""
+        ret = [self.obj]
+        for path in (self.ali, self.dep_file, self.target_properties,
+                     self.callgraph_info):
+            if path is not None:
+                ret.append(path)
+        return ret
+
+    def normalize(self, text):
+        return text.replace(self.root, ROOT_PLACEHOLDER)
+
+    def denormalize(self, text):
+        return text.replace(ROOT_PLACEHOLDER, self.root)
+
+    def key(self, compiler_id, final_root=None):
+        """The cache key of the compilation.
+
+        Objects with debug info embed the paths of their sources: in this
+        case the final location of the runtime is part of the key."""
+        h = hashlib.sha1()
+        h.update(compiler_id.encode())
+        for arg in self.args:
+            if arg.startswith(IGNORED_SWITCHES):
+                continue
+            if arg.startswith('-gnatec='):
+                # Configuration pragmas file: use its content
+                with open(self._abs(arg[len('-gnatec='):]), 'rb') as fp:
+                    arg = '-gnatec=' + _sha1(fp.read())
+            h.update(b'\0' + self.normalize(arg).encode())
+        if final_root is not None and \
+                any(arg.startswith('-g') and not arg.startswith('-gnat')
+                    for arg in self.args):
+            h.update(b'\0' + final_root.encode())
+        with open(self.source, 'rb') as fp:
+            h.update(b'\0' + fp.read())
+        return h.hexdigest()
+
+    def _ada_source_paths(self):
+        """Returns a dictionary of the Ada source base names to their path
+        """
+        ret = {}
+        if self.mapping_file is not None and \
+                os.path.isfile(self.mapping_file):
+            # Triplets of lines: unit name, file name, path
+            with open(self.mapping_file, 'r') as fp:
+                lines = fp.read().splitlines()
+            for i in range(0, len(lines) - 2, 3):
+                ret[lines[i + 1]] = lines[i + 2]
+        for d in ADA_SOURCE_DIRS:
+            full = os.path.join(self.root, d)
+            if not os.path.isdir(full):
+                continue
+            for fname in os.listdir(full):
+                if fname not in ret:
+                    ret[fname] = os.path.join(full, fname)
+        ret[os.path.basename(self.source)] = self.source
+        return ret
+
+    def dependencies(self):
+        """Returns the list of source files the compilation depended on,
+        once it has been done, or None if they cannot all be found"""
+        deps = []
+        if self.is_ada:
+            paths = self._ada_source_paths()
+            with open(self.ali, 'r') as fp:
+                for line in fp:
+                    if line.startswith('D '):
+                        name = line.split()[1]
+                        if name not in paths:
+                            return None
+                        deps.append(paths[name])
+        elif self.source.endswith('.s'):
+            # Not preprocessed
+            pass
+        elif self.dep_file is None or not os.path.isfile(self.dep_file):
+            return None
+        else:
+            with open(self.dep_file, 'r') as fp:
+                cnt = fp.read().replace('\\\n', ' ')
+            for line in cnt.splitlines():
+                if ':' not in line:
+                    continue
+                _, files = line.split(':', 1)
+                for f in files.split():
+                    deps.append(self._abs(f))
+        return sorted(set(deps))
+
+
+def _ali_timestamp(path):
+    """The timestamp of path, in the format used in the ALI files"""
+    return time.strftime('%Y%m%d%H%M%S', time.gmtime(os.path.getmtime(path)))
+
+
+def _update_ali_timestamps(text, paths):
+    """Sets the timestamps of the dependencies (D lines) of an ALI file to
+    the ones of the local sources, so that gprbuild considers the reused
+    object up-to-date"""
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+        if not line.startswith('D '):
+            continue
+        # D name timestamp checksum ...
+        items = line.split()
+        if len(items) < 3 or items[1] not in paths:
+            continue
+        stamp = _ali_timestamp(paths[items[1]])
+        lines[i] = line.replace(items[2], stamp, 1)
+    return '\n'.join(lines)
+
+
+class ObjectCache(object):
+    """Cache of compilation outputs, stored in the directory root"""
+
+    def __init__(self, root):
+        self.root = root
+        self._hashes = {}
+
+    def _file_hash(self, path):
+        if path not in self._hashes:
+            try:
+                with open(path, 'rb') as fp:
+                    self._hashes[path] = _sha1(fp.read())
+            except IOError:
+                self._hashes[path] = None
+        return self._hashes[path]
+
+    def _key_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _entries(self, key):
+        fname = os.path.join(self._key_dir(key), 'entries.json')
+        if not os.path.isfile(fname):
+            return []
+        try:
+            with open(fname, 'r') as fp:
+                return json.load(fp)
+        except ValueError:
+            return []
+
+    def lookup(self, comp, key):
+        """Restores the outputs of comp from the cache.
+
+        Returns the (stdout, stderr) of the cached compilation, or None if
+        there is no valid entry for comp."""
+        for entry in self._entries(key):
+            valid = True
+            for dep, sha1 in entry['deps'].items():
+                if self._file_hash(comp.denormalize(dep)) != sha1:
+                    valid = False
+                    break
+            if not valid:
+                continue
+            entry_dir = os.path.join(self._key_dir(key), entry['id'])
+            try:
+                self._restore(comp, entry_dir)
+            except (IOError, OSError):
+                # incomplete entry
+                continue
+            return entry['stdout'], entry['stderr']
+        return None
+
+    def _restore(self, comp, entry_dir):
+        paths = None
+        for dst in comp.outputs:
+            src = os.path.join(entry_dir, os.path.basename(dst))
+            if dst in (comp.ali, comp.dep_file, comp.callgraph_info):
+                with open(src, 'r') as fp:
+                    cnt = comp.denormalize(fp.read())
+                if dst == comp.ali:
+                    if paths is None:
+                        paths = comp._ada_source_paths()
+                    cnt = _update_ali_timestamps(cnt, paths)
+                with open(dst, 'w') as fp:
+                    fp.write(cnt)
+            else:
+                shutil.copyfile(src, dst)
+
+    def store(self, comp, key, stdout, stderr):
+        """Stores the outputs of the compilation comp, just done"""
+        dependencies = comp.dependencies()
+        if dependencies is None:
+            # unresolved dependencies: don't cache
+            return
+        deps = {}
+        for dep in dependencies:
+            sha1 = self._file_hash(dep)
+            if sha1 is None:
+                # unknown dependency: don't cache
+                return
+            deps[comp.normalize(dep)] = sha1
+
+        key_dir = self._key_dir(key)
+        if not os.path.isdir(key_dir):
+            try:
+                os.makedirs(key_dir)
+            except OSError:
+                # created concurrently
+                pass
+        entry_id = _sha1(json.dumps(deps, sort_keys=True).encode())
+        entry_dir = os.path.join(key_dir, entry_id)
+        if os.path.isdir(entry_dir):
+            return
+
+        # Fill a temporary directory, renamed when complete, so that
+        # concurrent compilations never see partial entries
+        tmp = tempfile.mkdtemp(dir=key_dir)
+        for path in comp.outputs:
+            dst = os.path.join(tmp, os.path.basename(path))
+            if path in (comp.ali, comp.dep_file, comp.callgraph_info):
+                with open(path, 'r') as fp:
+                    cnt = comp.normalize(fp.read())
+                with open(dst, 'w') as fp:
+                    fp.write(cnt)
+            else:
+                shutil.copyfile(path, dst)
+        try:
+            os.rename(tmp, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        entries = self._entries(key)
+        entries.append({'id': entry_id, 'deps': deps,
+                        'stdout': stdout, 'stderr': stderr})
+        fd, tmp = tempfile.mkstemp(dir=key_dir)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(json.dumps(entries, indent=1, sort_keys=True))
+        os.replace(tmp, os.path.join(key_dir, 'entries.json'))
+
+
+def cached_compile(compiler, args, cache_dir=None, root=None,
+                   compiler_id='', final_root=None, stats=None):
+    """Runs the compiler with args, using the object cache in cache_dir
+    if set.
+
+    ROOT is the directory of the runtime being compiled, FINAL_ROOT its
+    installation directory if different.
+    STATS, if set, is a dictionary where the compiled source ('source') and
+    whether the objects came from the cache ('cached') are stored.
+
+    Returns the exit status of the compilation."""
+    comp = Compilation(args, root or os.getcwd())
+    if stats is not None:
+        # Every compilation is recorded, even the ones that cannot be cached
+        stats['source'] = comp.source
+        stats['cached'] = False
+    cmd = [compiler] + list(args)
+    if cache_dir is None or root is None or not comp.cacheable:
+        return subprocess.call(cmd)
+
+    cache = ObjectCache(cache_dir)
+    key = comp.key(compiler_id, final_root)
+    res = cache.lookup(comp, key)
+    if res is not None:
+        if stats is not None:
+            stats['cached'] = True
+        sys.stdout.write(res[0])
+        sys.stderr.write(res[1])
+        return 0
+
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    out = out.decode(errors='replace')
+    err = err.decode(errors='replace')
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    if proc.returncode == 0:
+        try:
+            cache.store(comp, key, out, err)
+        except (IOError, OSError) as e:
+            sys.stderr.write('warning: cannot cache %s: %s\n' % (
+                comp.source, str(e)))
+    return proc.returncode
+
+
+def get_compiler_id(compiler, version=None):
+    """Identification of the compiler, part of the cache keys.
+
+    Combines the compiler version (see FilesHolder.gcc_version) and the
+    location and timestamp of the compiler driver."""
+    ret = [compiler, version or '']
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        exe = os.path.join(path, compiler)
+        if os.access(exe, os.X_OK):
+            st = os.stat(exe)
+            ret += [os.path.realpath(exe), str(st.st_size),
+                    str(calendar.timegm(time.gmtime(st.st_mtime)))]
+            break
+    return ':'.join(ret)
@@ -6,27 +6,50 @@
 # Python version starting from 2.6 (yes, it's very old but that's the system
 # python on oldest host).
 
-from support import is_string
-from support.files_holder import FilesHolder
+from support import is_string, write_if_changed
+from support.files_holder import FilesHolder, InstallManifest, copy_files
+from support.rts_sources.index import dump_index, index_path
 
+import hashlib
 import os
 from copy import deepcopy
 from json import dumps
 
 
-class Rule(object):
-    # Collect some statistics on scenario variable usage, to better generate
-    # the project file (most used scenario at the top-level of nested case
-    # statements)
-    __used_scenarios = {}
+class GenerationContext(object):
+    """State of the generation of a runtime source tree.
+
+    Each SourceTree has its own context, so that several trees can be
+    generated at the same time, in any order, with the same result."""
+
+    def __init__(self):
+        # Collect some statistics on scenario variable usage, to better
+        # generate the project file (most used scenario at the top-level of
+        # nested case statements)
+        self.used_scenarios = {}
+
+    def use_scenario(self, var):
+        if var not in self.used_scenarios:
+            self.used_scenarios[var] = 1
+        else:
+            self.used_scenarios[var] += 1
 
-    def __init__(self, rules, scenarios, as_new_rule=False):
+    def count_scenario(self, var):
+        if var in self.used_scenarios:
+            return self.used_scenarios[var]
+        else:
+            return 0
+
+
+class Rule(object):
+    def __init__(self, rules, scenarios, as_new_rule=False, context=None):
         """Create a new scenario variable condition rule.
 
         scenarios: check the rules against a list of scenario variables and
             accepted values. If None then no check is performed.
         as_new_rule: set to True if it's a rule added to the project file. This
-            increases the initial counter of used scenario variables"""
+            increases the initial counter of used scenario variables of the
+            generation context"""
         self._scenarios = {}
         self.invalid = False
 
@@ -87,12 +110,10 @@ class Rule(object):
                 break
 
         if as_new_rule:
+            assert context is not None, "no generation context for new rule"
             # Update the list of used scenario variables
             for sv in self._scenarios.keys():
-                if sv not in Rule.__used_scenarios:
-                    Rule.__used_scenarios[sv] = 1
-                else:
-                    Rule.__used_scenarios[sv] += 1
+                context.use_scenario(sv)
 
     @property
     def is_empty(self):
@@ -105,13 +126,6 @@ class Rule(object):
     def has_scenario(self, var):
         return var in self._scenarios.keys()
 
-    @staticmethod
-    def count_scenario(var):
-        if var in Rule.__used_scenarios:
-            return Rule.__used_scenarios[var]
-        else:
-            return 0
-
     def matches(self, variables, exact=False):
         """Considering a set of variables, returns true if the rules match"""
         if self.invalid:
@@ -155,8 +169,19 @@ class Rule(object):
 
 # Definitions of shared source files.
 
+def origins_path(json_file):
+    """The file recording the origin of the sources of the descriptor
+    json_file. As it holds paths of the build host, it is not stored next
+    to the descriptor but with the manifests of the installed sources (see
+    InstallManifest), under a name derived from the descriptor."""
+    key = hashlib.sha1(
+        os.path.realpath(json_file).encode('utf-8')).hexdigest()
+    return os.path.join(InstallManifest.state_dir, key + '.origins.json')
+
+
 class SourceTree(FilesHolder):
-    def __init__(self, is_bb, profile, rts_sources, rts_scenarios):
+    def __init__(self, is_bb, profile, rts_sources, rts_scenarios,
+                 context=None):
         """This initializes the framework to generate the runtime source tree.
 
         is_bb: whether we're generating a bare metal hierarchy or a PikeOS one
@@ -165,6 +190,7 @@ class SourceTree(FilesHolder):
          consider the sources appropriate for zfp, and 'ravenscar-sfp' will
          consider the sources for both zfp and ravenscar-sfp, but will not
          add the files that are ravenscar-full specific.
+        context: the GenerationContext to use, by default a new one
         """
         super(SourceTree, self).__init__()
         self._is_bb = is_bb
@@ -172,7 +198,9 @@ class SourceTree(FilesHolder):
         self.lib_scenarios = {'gnat': [], 'gnarl': []}
         self.rules = {'gnat': {}, 'gnarl': {}}
         self.deps = {}
-        SourceTree.__singleton = self
+        if context is None:
+            context = GenerationContext()
+        self.context = context
 
         if profile != 'ravenscar-full':
             if profile == 'zfp':
@@ -192,7 +220,9 @@ class SourceTree(FilesHolder):
                     continue
 
             if 'srcs' in values:
-                srcs = values['srcs']
+                # copy the list: it is extended below, and the rts_sources
+                # may be used to create several trees
+                srcs = list(values['srcs'])
             else:
                 srcs = []
             if self._is_bb:
@@ -213,11 +243,11 @@ class SourceTree(FilesHolder):
         # Sort the scenario variables from most used to less used
         self.lib_scenarios['gnat'] = sorted(
             self.lib_scenarios['gnat'],
-            key=lambda x: Rule.count_scenario(x),
+            key=lambda x: self.context.count_scenario(x),
             reverse=True)
         self.lib_scenarios['gnarl'] = sorted(
             self.lib_scenarios['gnarl'],
-            key=lambda x: Rule.count_scenario(x),
+            key=lambda x: self.context.count_scenario(x),
             reverse=True)
 
     def update_pairs(self, dir, pairs):
@@ -253,7 +283,8 @@ class SourceTree(FilesHolder):
             "directory %s defined twice" % directory
 
         # add the rule object to the current set of rules
-        rule = Rule(rules, scenarios=self.scenarios, as_new_rule=True)
+        rule = Rule(rules, scenarios=self.scenarios, as_new_rule=True,
+                    context=self.context)
 
         collection[directory] = rule
 
@@ -262,19 +293,31 @@ class SourceTree(FilesHolder):
             if sc not in used_scenarios:
                 used_scenarios.append(sc)
 
-    def install_tree(self, dest_json, dest_sources):
-        """Install the runtime sources"""
+    def install_tree(self, dest_json, dest_sources, jobs=0):
+        """Install the runtime sources
+
+        Files are copied using JOBS threads (0 meaning one per CPU), and only
+        the files that changed since the previous installation in
+        dest_sources are actually rewritten."""
         # Dump the json file describing the sources
         self.dump_json(dest_json, dest_sources)
 
         # now install the rts sources
-        if not os.path.exists(dest_sources):
-            os.makedirs(dest_sources)
+        copy_files(self.source_copies(dest_sources), jobs=jobs,
+                   manifest=InstallManifest(dest_sources))
+
+    def source_copies(self, dest_sources):
+        """Creates the source directories in dest_sources, and returns the
+        list of (src, dst) copies needed to populate them"""
+        # Several trees may be installed concurrently in dest_sources
+        os.makedirs(dest_sources, exist_ok=True)
         dirs = []
         dirs += self.rules['gnat'].keys()
         dirs += self.rules['gnarl'].keys()
+        copies = []
         for d in dirs:
-            self.__install_dir(d, dest_sources)
+            copies += self.__install_dir(d, dest_sources)
+        return copies
 
     def dump_json(self, path, dest_sources):
         cnt = {}
@@ -296,8 +339,32 @@ class SourceTree(FilesHolder):
                 dirs=deepcopy(self.rules[lib]),
                 env={})
 
-        with open(path, 'w') as fp:
-            fp.write(dumps(cnt, indent=2, sort_keys=True))
+        # Only write the descriptor if it changed, so that its timestamp
+        # is preserved for the tools relying on it
+        write_if_changed(path, dumps(cnt, indent=2, sort_keys=True))
+        # and its indexed form, loaded by the installer
+        write_if_changed(index_path(path), dump_index(cnt, path))
+        # and the origin of the installed sources, used to find the
+        # runtimes affected by a change without the GNAT sources
+        origins = origins_path(path)
+        if not os.path.isdir(os.path.dirname(origins)):
+            os.makedirs(os.path.dirname(origins), exist_ok=True)
+        write_if_changed(
+            origins,
+            dumps(self.source_origins(dest_sources, os.path.dirname(path)),
+                  indent=1, sort_keys=True))
+
+    def source_origins(self, dest_sources, dest_json):
+        """Returns the dictionary of the sources installed in dest_sources
+        (relative to dest_json) to the files they come from"""
+        ret = {}
+        for lib in ('gnat', 'gnarl'):
+            for d in self.rules[lib]:
+                for pair in self.dirs[d]:
+                    installed = os.path.join(dest_sources, d, pair.dst)
+                    ret[os.path.relpath(installed, dest_json)] = \
+                        os.path.abspath(pair.src)
+        return ret
 
     def dump_sources_json(self, dest_sources, dest_json,
                           libname, scenarios, dirs, env):
@@ -366,13 +433,14 @@ class SourceTree(FilesHolder):
         return ret
 
     def __install_dir(self, dirname, dest_sources):
+        """Creates the destination directory and returns the list of
+        (src, dst) copies needed to populate it"""
         if dirname not in self.dirs:
             print('undefined shared directory %s' % dirname)
 
         destdir = os.path.join(dest_sources, dirname)
 
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
+        os.makedirs(destdir, exist_ok=True)
 
-        for pair in self.dirs[dirname]:
-            pair.install(destdir)
+        return [(pair.src, os.path.join(destdir, pair.dst))
+                for pair in self.dirs[dirname]]
@@ -0,0 +1,210 @@
+"""Compact indexed form of the runtime sources descriptor.
+
+rts-sources.json is the interchange format describing the runtime
+sources: a tree of source directories, nested under the scenario
+conditions (var:value) that select them. gen_rts_sources.py also writes
+rts-sources.idx next to it, a binary form of the same information that is
+loaded without any parsing:
+
+  header     magic 'RTSIDX', format version (u16), size (u64), mtime in ns
+             (u64) and sha1 (20 bytes) of the json descriptor it was made
+             from
+  strings    u32 size, then the utf-8 strings separated by NUL characters
+  bits       u16 count, then for each bit: the (var, value) string indexes
+             of a scenario condition
+  width      u16: the size in bytes of the condition masks
+  libs       u16 count, then for each library:
+               name string index
+               u16 count of scenario variables, then for each one: the
+                 variable name index, u16 count of values, value indexes
+               u32 count of directories, then for each directory: its path
+                 string index (relative to the descriptor), its mask, and
+                 the list of its conditions in the tree order (u8 count,
+                 u16 bit numbers), used for reporting
+
+A directory is selected when all the conditions of its mask are set by the
+scenario variables of the runtime. The directories are listed in the order
+of a depth-first walk of the json tree, so that selecting them with a
+linear scan gives the same list as walking the tree.
+
+All integers are little-endian.
+"""
+
+import hashlib
+import os
+import struct
+
+MAGIC = b'RTSIDX'
+VERSION = 1
+
+_HEADER = struct.Struct('<6sHQQ20s')
+
+
+def index_path(json_file):
+    """The index of the descriptor json_file"""
+    return os.path.splitext(json_file)[0] + '.idx'
+
+
+def _flatten(item, conditions, ret):
+    """Depth-first walk of a json sources tree, appending the (dir,
+    conditions) pairs to ret. The keys are walked in the order of the json
+    file (sorted)."""
+    for d in item.get('_srcs', []):
+        ret.append((d, conditions))
+    for k in sorted(item.keys()):
+        if k == '_srcs':
+            continue
+        sub = item[k]
+        var, value = k.split(':')
+        _flatten(sub, conditions + [(var, value)], ret)
+
+
+def dump_index(cnt, json_file):
+    """Returns the index of the descriptor content cnt, stored in json_file
+    """
+    strings = []
+    string_ids = {}
+
+    def sid(s):
+        if s not in string_ids:
+            string_ids[s] = len(strings)
+            strings.append(s)
+        return string_ids[s]
+
+    bits = []
+    bit_ids = {}
+    libs = []
+    for lib in sorted(cnt.keys()):
+        dirs = []
+        _flatten(cnt[lib]['sources'] or {}, [], dirs)
+        masks = []
+        for d, conditions in dirs:
+            mask = 0
+            for cond in conditions:
+                if cond not in bit_ids:
+                    bit_ids[cond] = len(bits)
+                    bits.append(cond)
+                mask |= 1 << bit_ids[cond]
+            masks.append((sid(d), mask, [bit_ids[c] for c in conditions]))
+        scenarios = [(sid(var), [sid(v) for v in values])
+                     for var, values in sorted(cnt[lib]['scenarios'].items())]
+        libs.append((sid(lib), scenarios, masks))
+    width = (len(bits) + 7) // 8
+
+    with open(json_file, 'rb') as fp:
+        sha1 = hashlib.sha1(fp.read()).digest()
+    st = os.stat(json_file)
+    out = [_HEADER.pack(MAGIC, VERSION, st.st_size, st.st_mtime_ns, sha1)]
+    blob = '\0'.join(strings).encode('utf-8')
+    out.append(struct.pack('<I', len(blob)) + blob)
+    out.append(struct.pack('<H', len(bits)))
+    for var, value in bits:
+        out.append(struct.pack('<HH', sid(var), sid(value)))
+    out.append(struct.pack('<HH', width, len(libs)))
+    for name, scenarios, masks in libs:
+        out.append(struct.pack('<HH', name, len(scenarios)))
+        for var, values in scenarios:
+            out.append(struct.pack('<HH', var, len(values)))
+            out.append(struct.pack('<%dH' % len(values), *values))
+        out.append(struct.pack('<I', len(masks)))
+        for d, mask, ids in masks:
+            out.append(struct.pack('<H', d) + mask.to_bytes(width, 'little'))
+            out.append(struct.pack('<B%dH' % len(ids), len(ids), *ids))
+    return b''.join(out)
+
+
+class RTSSourcesIndex(object):
+    """Reader of the index of a runtime sources descriptor"""
+
+    def __init__(self, data, base):
+        self.base = base
+        self.libs = {}
+        (_, _, self.json_size, self.json_mtime_ns,
+         self.json_sha1) = _HEADER.unpack_from(data, 0)
+        pos = _HEADER.size
+
+        n, = struct.unpack_from('<I', data, pos)
+        strings = data[pos + 4:pos + 4 + n].decode('utf-8').split('\0')
+        pos += 4 + n
+
+        n, = struct.unpack_from('<H', data, pos)
+        pairs = struct.unpack_from('<%dH' % (2 * n), data, pos + 2)
+        pos += 2 + 4 * n
+        # bit mask of each (var, value) condition, and the reverse mapping
+        self.bits = {}
+        self.conditions = []
+        for i in range(n):
+            var, value = strings[pairs[2 * i]], strings[pairs[2 * i + 1]]
+            self.bits[(var, value)] = 1 << i
+            self.conditions.append('%s:%s' % (var, value))
+
+        width, n_libs = struct.unpack_from('<HH', data, pos)
+        pos += 4
+        # full path of the directories, by string index
+        paths = {}
+        for _ in range(n_libs):
+            name, n = struct.unpack_from('<HH', data, pos)
+            pos += 4
+            scenarios = {}
+            for _ in range(n):
+                var, n_values = struct.unpack_from('<HH', data, pos)
+                pos += 4
+                values = struct.unpack_from('<%dH' % n_values, data, pos)
+                pos += 2 * n_values
+                scenarios[strings[var]] = [strings[v] for v in values]
+            n, = struct.unpack_from('<I', data, pos)
+            pos += 4
+            dirs = []
+            for _ in range(n):
+                d, = struct.unpack_from('<H', data, pos)
+                if d not in paths:
+                    paths[d] = os.path.normpath(
+                        os.path.join(base, strings[d]))
+                mask = int.from_bytes(data[pos + 2:pos + 2 + width], 'little')
+                pos += 2 + width
+                n_ids = data[pos]
+                ids = struct.unpack_from('<%dH' % n_ids, data, pos + 1)
+                pos += 1 + 2 * n_ids
+                dirs.append((paths[d], mask, ids))
+            self.libs[strings[name]] = (scenarios, dirs)
+
+    @staticmethod
+    def load(json_file):
+        """Returns the index of the descriptor json_file, or None if there
+        is no index, or if it does not correspond to the descriptor"""
+        fname = index_path(json_file)
+        try:
+            with open(fname, 'rb') as fp:
+                data = fp.read()
+            st = os.stat(json_file)
+        except (IOError, OSError):
+            return None
+        if len(data) < _HEADER.size:
+            return None
+        magic, version, size, mtime_ns, sha1 = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION or size != st.st_size:
+            return None
+        if mtime_ns != st.st_mtime_ns:
+            # The descriptor may have been copied: check its content
+            with open(json_file, 'rb') as fp:
+                if hashlib.sha1(fp.read()).digest() != sha1:
+                    return None
+        return RTSSourcesIndex(data, os.path.dirname(json_file))
+
+    def scenarios(self, lib):
+        return self.libs[lib][0]
+
+    def source_dirs(self, lib, scenarios):
+        """The directories of lib selected by the scenario variables"""
+        selected = 0
+        for var, value in scenarios.items():
+            selected |= self.bits.get((var, value), 0)
+        return [d for d, mask, _ in self.libs[lib][1]
+                if mask & selected == mask]
+
+    def directories(self, lib):
+        """The list of (directory, conditions) of lib, conditions being the
+        list of var:value conditions selecting the directory, outermost
+        first"""
+        return [(d, [self.conditions[i] for i in ids])
+                for d, _, ids in self.libs[lib][1]]
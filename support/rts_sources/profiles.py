@@ -5,6 +5,8 @@
 # BSP to actually create a runtime project.
 
 import sys
+from collections import deque
+from support.files_holder import FilesHolder
 from support.rts_sources import Rule
 from support.rts_sources.sources import all_scenarios, sources
 
@@ -23,26 +25,88 @@ class RTSProfiles(object):
         # that are necessary to configure the runtime sources.
         self.config = config
 
-    def check_deps(self, scenarios):
-        while True:
-            modified = False
+    # The 'requires' relationships of the runtime sources, see
+    # _dependency_graph
+    _deps = None
+    _deps_by_var = None
+
+    @staticmethod
+    def _dependency_graph():
+        """Compiles the 'requires' relationships of the runtime sources.
+
+        Returns the list of (directory, conditions, requirements) tuples,
+        where conditions is None when the requirements are unconditional,
+        and a dictionary giving, for each scenario variable, the indexes of
+        the tuples whose conditions or requirements use it."""
+        if RTSProfiles._deps is None:
+            deps = []
+            by_var = {}
             for d, content in sources.items():
-                matches = False
                 if 'requires' not in content:
                     continue
-                if 'conditions' not in content:
-                    matches = True
+                if 'conditions' in content:
+                    cond = Rule(content['conditions'], all_scenarios)
                 else:
-                    rule = Rule(content['conditions'], all_scenarios)
-                    if rule.matches(scenarios):
-                        matches = True
-                if matches:
-                    dep = Rule(content['requires'], all_scenarios)
-                    if not dep.matches(scenarios):
-                        modified = True
-                        scenarios.update(dep.corresponding_scenario())
-            if not modified:
-                break
+                    cond = None
+                req = Rule(content['requires'], all_scenarios)
+                variables = set(req.used_scenarios)
+                if cond is not None:
+                    variables.update(cond.used_scenarios)
+                for var in variables:
+                    by_var.setdefault(var, []).append(len(deps))
+                deps.append((d, cond, req))
+            RTSProfiles._deps = deps
+            RTSProfiles._deps_by_var = by_var
+        return RTSProfiles._deps, RTSProfiles._deps_by_var
+
+    def check_deps(self, scenarios):
+        """Updates scenarios so that the requirements of the selected
+        runtime sources are met.
+
+        Returns the chain of implied settings, as a list of
+        (variable, value, directory, causes) tuples: variable has been set
+        to value as required by directory, itself selected because of the
+        causes, the list of previously implied variables its conditions
+        depend on."""
+        deps, by_var = self._dependency_graph()
+        chain = []
+        implied = set()
+
+        # Single worklist pass: a relationship is checked again only when
+        # one of the variables it depends on changes.
+        worklist = deque(range(len(deps)))
+        queued = set(worklist)
+        while len(worklist) > 0:
+            idx = worklist.popleft()
+            queued.discard(idx)
+            d, cond, req = deps[idx]
+            if cond is not None and not cond.matches(scenarios):
+                continue
+            if req.matches(scenarios):
+                continue
+            if cond is None:
+                causes = []
+            else:
+                causes = sorted(v for v in cond.used_scenarios if v in implied)
+            for var, value in sorted(req.corresponding_scenario().items()):
+                if scenarios.get(var) == value:
+                    continue
+                scenarios[var] = value
+                implied.add(var)
+                chain.append((var, value, d, causes))
+                if FilesHolder.verbose:
+                    msg = "%s (%s): %s set to %s" % (
+                        self.config.name, scenarios.get('RTS_Profile'),
+                        var, value)
+                    msg += ", required by %s" % d
+                    if len(causes) > 0:
+                        msg += " (selected by %s)" % ', '.join(causes)
+                    print(msg)
+                for dep_idx in by_var.get(var, []):
+                    if dep_idx not in queued:
+                        queued.add(dep_idx)
+                        worklist.append(dep_idx)
+        return chain
 
     def zfp_scenarios(self, math_lib, profile='zfp'):
         """Returns the list of directories contained in a base ZFP runtime"""
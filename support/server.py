@@ -0,0 +1,196 @@
+"""Long-lived build_rts.py service.
+
+The server keeps the target modules imported and the indexes built by
+previous requests (MANIFEST.GNAT, resolved source files, runtime source
+descriptors) and runs build_rts.py requests received over a Unix socket.
+rts_client.py is the corresponding thin client.
+
+Protocol: the client sends a single json line with the command line
+arguments, its working directory and its environment. The server runs
+the request with its standard output and error (including the ones of
+the subprocesses) redirected to the connection, then sends a NUL
+character followed by the exit status and a newline.
+"""
+
+import json
+import os
+import socket
+import sys
+import traceback
+
+from support import fullpath
+from support.bsp_sources.installer import Installer, InstallPlan
+from support.files_holder import FilesHolder
+
+
+class SourceWatcher(object):
+    """Detects changes in the source roots that invalidate the indexes of
+    the server.
+
+    The indexes only depend on which files exist (not on their content),
+    so the modification times of the source roots, of MANIFEST.GNAT, and
+    of the directories where each resolved source is or could be found
+    are enough to detect changes. A file added to the repository can
+    shadow a file of gcc, so the repository location of the sources found
+    in gcc is watched too (or its closest existing parent, which changes
+    when the missing directories are created)."""
+
+    def __init__(self):
+        self._signature = None
+
+    @staticmethod
+    def _existing_dir(path):
+        path = os.path.dirname(path)
+        while path and not os.path.isdir(path):
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        return path
+
+    def _paths(self):
+        gnatdir = FilesHolder.gnatdir
+        gccdir = FilesHolder.gccdir
+        paths = set([os.path.normpath(fullpath('.')), gnatdir, gccdir,
+                     os.path.join(gnatdir, 'MANIFEST.GNAT'),
+                     os.path.join(gccdir, 'gcc', 'BASE-VER')])
+        for sub in ('hie', 'libgnarl', 'libgnat'):
+            paths.add(os.path.join(gnatdir, sub))
+        for (_, _, src), path in list(FilesHolder.resolved_sources.items()):
+            paths.add(self._existing_dir(path))
+            if '/' in src:
+                paths.add(self._existing_dir(fullpath(src)))
+                paths.add(self._existing_dir(os.path.join(gccdir, src)))
+        for path in list(Installer._gprls_descriptors.values()):
+            paths.add(path)
+        return sorted(paths)
+
+    def signature(self):
+        ret = []
+        for path in self._paths():
+            try:
+                st = os.stat(path)
+                ret.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                ret.append((path, None, None))
+        return ret
+
+    def check(self):
+        """Invalidates the indexes if the sources changed since the last
+        call to update. Returns whether they were invalidated."""
+        if self._signature is None or self.signature() == self._signature:
+            return False
+        FilesHolder.resolved_sources.clear()
+        FilesHolder.manifest = None
+        FilesHolder._gcc_version = None
+        Installer._gprls_descriptors.clear()
+        return True
+
+    def update(self):
+        """Records the state of the sources the indexes now rely on"""
+        self._signature = self.signature()
+
+
+class BuildServer(object):
+    """Runs the requests received on socket_path with main, a function
+    taking the list of command line arguments"""
+
+    # Class attributes set from the command line, restored after each
+    # request
+    settings = ((FilesHolder, 'verbose'), (FilesHolder, 'link'),
+                (FilesHolder, 'resolve_sources'), (Installer, 'overwrite'),
+                (InstallPlan, 'state_dir'))
+
+    def __init__(self, socket_path, main):
+        self.socket_path = os.path.abspath(socket_path)
+        self.main = main
+        self.watcher = SourceWatcher()
+        # The requests are run from the client's directory
+        FilesHolder.gnatdir = os.path.abspath(FilesHolder.gnatdir)
+        FilesHolder.gccdir = os.path.abspath(FilesHolder.gccdir)
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The requests run with the rights of the server: only its user
+        # may connect
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, 0o600)
+        sock.listen(16)
+        print("build_rts server listening on %s" % self.socket_path)
+        sys.stdout.flush()
+        try:
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    self.handle(conn)
+                except (IOError, OSError) as e:
+                    print("request aborted: %s" % str(e))
+                finally:
+                    conn.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            os.unlink(self.socket_path)
+
+    def _read_request(self, conn):
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data.decode())
+
+    def handle(self, conn):
+        request = self._read_request(conn)
+        if self.watcher.check():
+            print("sources changed: indexes invalidated")
+
+        saved_settings = [(obj, attr, getattr(obj, attr))
+                          for obj, attr in self.settings]
+        saved_env = dict(os.environ)
+        saved_cwd = os.getcwd()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_fds = (os.dup(1), os.dup(2))
+        status = 0
+        try:
+            os.environ.clear()
+            os.environ.update(request.get('env', {}))
+            os.chdir(request.get('cwd', saved_cwd))
+            os.dup2(conn.fileno(), 1)
+            os.dup2(conn.fileno(), 2)
+            try:
+                self.main(request['argv'])
+            except SystemExit as e:
+                if e.code is None:
+                    status = 0
+                elif isinstance(e.code, int):
+                    status = e.code
+                else:
+                    print(e.code)
+                    status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+            os.chdir(saved_cwd)
+            os.environ.clear()
+            os.environ.update(saved_env)
+            for obj, attr, value in saved_settings:
+                setattr(obj, attr, value)
+            self.watcher.update()
+        conn.sendall(b'\0' + str(status).encode() + b'\n')
@@ -0,0 +1,271 @@
+"""Worst-case stack usage of the runtimes.
+
+The runtimes are compiled with -fcallgraph-info=su,da (see
+Target.build_flags), which makes the compiler produce, for each unit, a
+.ci file in the object directory. Those files describe, in the VCG
+format, the functions of the unit with their stack usage, and the calls
+they make:
+
+  node: { title: "f" label: "f\\nfile.adb:12:4\\n32 bytes (static)\\n..." }
+  edge: { sourcename: "f" targetname: "g" label: "file.adb:14:7" }
+
+This module builds the call graph of a whole runtime from those files, and
+computes the worst-case stack usage of its entry points: the functions that
+are not called from the runtime, the task bodies and the interrupt
+handlers. The call chains reaching an indirect call, a recursion, a
+dynamically sized frame or a function without stack usage information are
+reported, as the computed bound is then only a lower bound.
+"""
+
+import json
+import os
+import re
+
+# Name of the indirect calls target in the .ci files
+INDIRECT_CALL = '__indirect_call'
+
+_ITEM_RE = re.compile(r'(node|edge):\s*\{(.*?)\}\s*$', re.M)
+_ATTR_RE = re.compile(r'(\w+)\s*:\s*"((?:[^"\\]|\\.)*)"')
+_STACK_RE = re.compile(r'(\d+) bytes \(([\w,]+)\)')
+
+# Task bodies, as named by GNAT
+_TASK_BODY_RE = re.compile(r'.*TKB(\.\d+)?$')
+
+# Interrupt and trap handlers of the runtimes
+_HANDLER_RE = re.compile(
+    r'.*(_handler|_Handler|irq_trap|fiq_trap|_trap_handler|'
+    r'__gnat_irq|__gnat_fiq|__gnat_error_handler)\w*$')
+
+
+class Function(object):
+    def __init__(self, name):
+        self.name = name
+        self.stack = None
+        self.qualifier = None
+        self.location = None
+        self.calls = []
+
+    @property
+    def defined(self):
+        return self.stack is not None
+
+
+class CallGraph(object):
+    """Call graph built from a set of .ci files"""
+
+    def __init__(self):
+        self.functions = {}
+
+    def function(self, name):
+        if name not in self.functions:
+            self.functions[name] = Function(name)
+        return self.functions[name]
+
+    def add_file(self, path):
+        with open(path, 'r') as fp:
+            cnt = fp.read()
+        for kind, body in _ITEM_RE.findall(cnt):
+            attrs = dict(_ATTR_RE.findall(body))
+            if kind == 'node':
+                if 'title' not in attrs:
+                    continue
+                fun = self.function(attrs['title'])
+                lines = attrs.get('label', '').split('\\n')
+                for line in lines[2:]:
+                    m = _STACK_RE.match(line)
+                    if m is not None:
+                        stack = int(m.group(1))
+                        # An inline function may be defined in several
+                        # units
+                        if fun.stack is None or stack > fun.stack:
+                            fun.stack = stack
+                            fun.qualifier = m.group(2)
+                            fun.location = lines[1]
+            elif 'sourcename' in attrs and 'targetname' in attrs:
+                caller = self.function(attrs['sourcename'])
+                if attrs['targetname'] not in caller.calls:
+                    caller.calls.append(attrs['targetname'])
+                self.function(attrs['targetname'])
+
+    def add_dir(self, obj_dir):
+        for fname in sorted(os.listdir(obj_dir)):
+            if fname.endswith('.ci'):
+                self.add_file(os.path.join(obj_dir, fname))
+
+    def cycles(self):
+        """Returns the strongly connected components of the graph that
+        contain a cycle (Tarjan's algorithm, iterative)"""
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        ret = []
+        counter = [0]
+
+        for root in sorted(self.functions):
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                name, i = work.pop()
+                if i == 0:
+                    index[name] = low[name] = counter[0]
+                    counter[0] += 1
+                    stack.append(name)
+                    on_stack.add(name)
+                calls = self.functions[name].calls
+                recurse = False
+                while i < len(calls):
+                    callee = calls[i]
+                    i += 1
+                    if callee not in index:
+                        work.append((name, i))
+                        work.append((callee, 0))
+                        recurse = True
+                        break
+                    elif callee in on_stack:
+                        low[name] = min(low[name], index[callee])
+                if recurse:
+                    continue
+                if low[name] == index[name]:
+                    scc = []
+                    while True:
+                        item = stack.pop()
+                        on_stack.discard(item)
+                        scc.append(item)
+                        if item == name:
+                            break
+                    if len(scc) > 1 or name in self.functions[name].calls:
+                        ret.append(sorted(scc))
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[name])
+        return ret
+
+    def worst_case(self):
+        """Computes the worst-case stack usage of each function.
+
+        Returns a dictionary of function name to (stack, path, issues),
+        where path is the worst-case call chain and issues is a dictionary
+        of the problems found in the call tree."""
+        in_cycle = {}
+        for scc in self.cycles():
+            for name in scc:
+                in_cycle[name] = scc
+        result = {}
+
+        def issues_of(fun):
+            ret = {}
+            if fun.name == INDIRECT_CALL:
+                return ret
+            if not fun.defined:
+                ret['unknown'] = [fun.name]
+            elif fun.qualifier != 'static' and \
+                    fun.qualifier != 'dynamic,bounded':
+                ret['dynamic'] = [fun.name]
+            if INDIRECT_CALL in fun.calls:
+                ret['indirect_calls'] = [fun.name]
+            if fun.name in in_cycle:
+                ret['recursion'] = list(in_cycle[fun.name])
+            return ret
+
+        # Iterative post-order traversal: the callees are computed first.
+        # Calls within a recursion are ignored for the stack computation.
+        for root in sorted(self.functions):
+            if root in result:
+                continue
+            work = [(root, False)]
+            visiting = set()
+            while work:
+                name, done = work.pop()
+                if name in result:
+                    continue
+                fun = self.functions[name]
+                cycle = in_cycle.get(name, ())
+                if not done:
+                    if name in visiting:
+                        continue
+                    visiting.add(name)
+                    work.append((name, True))
+                    for callee in fun.calls:
+                        if callee not in result and callee not in cycle:
+                            work.append((callee, False))
+                    continue
+                best = 0
+                path = [name]
+                issues = issues_of(fun)
+                for callee in fun.calls:
+                    if callee in cycle or callee not in result:
+                        continue
+                    c_stack, c_path, c_issues = result[callee]
+                    if c_stack > best:
+                        best = c_stack
+                        path = [name] + c_path
+                    for kind, names in c_issues.items():
+                        lst = issues.setdefault(kind, [])
+                        for n in names:
+                            if n not in lst:
+                                lst.append(n)
+                own = fun.stack if fun.stack is not None else 0
+                result[name] = (own + best, path, issues)
+        return result
+
+    def entry_points(self):
+        """Returns the list of (name, kind) entry points of the graph"""
+        called = set()
+        for fun in self.functions.values():
+            called.update(fun.calls)
+        ret = []
+        for name in sorted(self.functions):
+            fun = self.functions[name]
+            if not fun.defined:
+                continue
+            if _TASK_BODY_RE.match(name):
+                ret.append((name, 'task'))
+            elif _HANDLER_RE.match(name):
+                ret.append((name, 'interrupt'))
+            elif name not in called:
+                ret.append((name, 'root'))
+        return ret
+
+
+def analyze(obj_dirs, entries=None):
+    """Analyzes the .ci files of obj_dirs.
+
+    ENTRIES is an optional list of additional entry points. Returns the
+    report as a json-serializable dictionary."""
+    graph = CallGraph()
+    for d in obj_dirs:
+        if os.path.isdir(d):
+            graph.add_dir(d)
+    wcs = graph.worst_case()
+    points = graph.entry_points()
+    if entries is not None:
+        known = set(name for name, _ in points)
+        for name in entries:
+            if name in graph.functions and name not in known:
+                points.append((name, 'user'))
+
+    report = []
+    for name, kind in points:
+        stack, path, issues = wcs[name]
+        report.append({
+            'name': name,
+            'kind': kind,
+            'location': graph.functions[name].location,
+            'stack': stack,
+            # The stack usage is a safe upper bound only if there is no
+            # issue in the call tree
+            'bounded': len(issues) == 0,
+            'path': path,
+            'issues': dict((k, sorted(v)) for k, v in issues.items())})
+    report.sort(key=lambda e: (-e['stack'], e['name']))
+    return {'entry_points': report,
+            'cycles': graph.cycles(),
+            'functions': len(graph.functions)}
+
+
+def write_report(report, filename):
+    with open(filename, 'w') as fp:
+        fp.write(json.dumps(report, indent=1, sort_keys=True))
+        fp.write('\n')